@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+# Compares the memory of the array stop catalogue with the dict layout
+# used before it, built from the same datasets in data/ (nothing is
+# downloaded). The dict layout also kept the raw datasets loaded.
+#
+# Usage: python bench/catalogue.py
+
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import crtm.catalogue as catalogue  # noqa: E402
+import crtm.utils as ut  # noqa: E402
+
+
+def dict_catalogue(raw):
+    proc = {}
+    for source in ut.SOURCES:
+        cat = proc[source] = {
+            "index": {},
+            "names": [],
+            "ids": [],
+            "stopids": [],
+            "stops": {},
+            "lines": {},
+        }
+        for idx, (key, info) in enumerate(ut.entries(source, raw[source])):
+            cat["index"][key] = idx
+            cat["names"].append(info["name"])
+            cat["ids"].append(key)
+            if source == "bici":
+                cat["stopids"].append(info["id"])
+            elif source == "cerc":
+                first = info["name"][0]
+                cat["stops"].setdefault(first, []).append(idx)
+                for line in info["lineIds"]:
+                    lines = cat["lines"].setdefault(line, {})
+                    lines.setdefault(first, []).append(idx)
+    cat = proc["metro"] = {
+        "index": {},
+        "names": [],
+        "ids": [],
+        "stops": {},
+        "lines": {},
+    }
+    for idx, st in enumerate(raw["metro"]["red"]["estaciones"]["estacion"]):
+        first = st["name"][0]
+        cat["index"][st["idweb"]] = idx
+        cat["names"].append(st["name"])
+        cat["ids"].append(st["idweb"])
+        cat["stops"].setdefault(first, []).append(idx)
+        lines = cat["lines"].setdefault(st["linea"], {})
+        lines.setdefault(first, []).append(idx)
+    return proc
+
+
+def array_catalogue(raw):
+    ut.DATA = {
+        "proc": {
+            transport: catalogue.Catalogue()
+            for transport in ut.SOURCES + ("metro",)
+        }
+    }
+    for source in ut.SOURCES:
+        ut.build_stops(source, raw[source])
+    ut.metro_lines(ut.DATA["proc"]["metro"], raw["metro"])
+    return ut.DATA["proc"]
+
+
+def measure(build, raw):
+    before, _ = tracemalloc.get_traced_memory()
+    built = build(raw)
+    after, _ = tracemalloc.get_traced_memory()
+    del built
+    return (after - before) / 2**20
+
+
+def main():
+    ut.DOWNLOAD = False
+    tracemalloc.start()
+    raw = ut.load_data()
+    raw_mib = tracemalloc.get_traced_memory()[0] / 2**20
+    array_mib = measure(array_catalogue, raw)
+    ut.DATA = None
+    dict_mib = measure(dict_catalogue, raw)
+    tracemalloc.stop()
+    print(f"raw datasets: {raw_mib:.1f} MiB")
+    print(f"array catalogue: {array_mib:.1f} MiB")
+    print(
+        f"dict layout: {dict_mib:.1f} MiB, "
+        f"{dict_mib + raw_mib:.1f} MiB with the raw datasets"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+# Measures the cold start of the bot: module import time (-X importtime)
+# and time until the first update is answered. Telegram is never
+# called: the bot identity is set locally and the answer is caught at
+# the outbox. Exits with 1 when a budget is exceeded.
+#
+# Usage: python bench/startup.py [--runs 5] [--imports 800] [--first 5000]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST = """
+import queue
+import threading
+import time
+start = time.perf_counter()
+import telegram
+import telegram.ext as ext
+import crtm.__main__ as main
+import crtm.database as db
+import crtm.outbox as outbox
+import crtm.utils as ut
+ut.DOWNLOAD = False
+ut.load_config()
+db.setup_db()
+bot = telegram.Bot(ut.setting("token"))
+bot._bot = telegram.User(1, "bench", True, username="bench_bot")
+dispatcher = ext.Dispatcher(bot, queue.Queue(), workers=0, use_context=True)
+main.setup_handlers(dispatcher)
+ut.update_data(None)
+answered = threading.Event()
+outbox.call = lambda *args, **kwargs: answered.set()
+message = {
+    "message_id": 1,
+    "date": 0,
+    "chat": {"id": 1, "type": "private"},
+    "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+    "text": "/menu",
+    "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+}
+dispatcher.process_update(
+    telegram.Update.de_json({"update_id": 1, "message": message}, bot)
+)
+answered.wait(60)
+print(time.perf_counter() - start)
+"""
+
+
+def imports():
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import crtm.__main__"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # top level imports are the ones not indented
+        if not name.startswith("  "):
+            modules.append((int(cumulative), name.strip()))
+    return sum(us for us, _ in modules) / 1000, sorted(modules)[::-1]
+
+
+def first_update():
+    proc = subprocess.run(
+        [sys.executable, "-c", FIRST],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(proc.stdout.split()[-1]) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--imports", type=float, default=800, help="import budget (ms)"
+    )
+    parser.add_argument(
+        "--first",
+        type=float,
+        default=5000,
+        help="first update budget (ms)",
+    )
+    parser.add_argument(
+        "--no-first",
+        action="store_true",
+        help="skip the first update measure (needs config and data files)",
+    )
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.runs):
+        total, modules = imports()
+        totals.append(total)
+    import_ms = statistics.median(totals)
+    print(f"imports: {import_ms:.0f} ms (budget {args.imports:.0f} ms)")
+    for us, name in modules[:10]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    failed = import_ms > args.imports
+
+    if not args.no_first:
+        start = time.perf_counter()
+        first_ms = statistics.median(first_update() for _ in range(args.runs))
+        print(
+            f"first update: {first_ms:.0f} ms (budget {args.first:.0f} ms, "
+            f"measured in {time.perf_counter() - start:.1f}s)"
+        )
+        failed = failed or first_ms > args.first
+
+    if failed:
+        print("Startup budget exceeded")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
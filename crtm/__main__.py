@@ -5,24 +5,18 @@
 
 import logging
 import os
+import time
 
-from telegram.ext import (
-    CallbackQueryHandler,
-    ChosenInlineResultHandler,
-    CommandHandler,
-    Filters,
-    InlineQueryHandler,
-    MessageHandler,
-    Updater,
-)
-
-import crtm.cli as cli
-import crtm.database as db
-import crtm.gui as gui
 import crtm.utils as ut
 
 
+# telegram and the handler modules are only imported once the config
+# is known to exist, the first callback or setup_handlers loads them
 def button_handler(update, context):
+    import crtm.cli as cli
+    import crtm.database as db
+    import crtm.gui as gui
+
     query = update.callback_query
     if query.inline_message_id is not None:
         cli.inline_text(update, context, query.inline_message_id, query.data)
@@ -47,6 +41,19 @@ def button_handler(update, context):
             elif query.data.startswith("time_train"):
                 args = query.data.split("_")
                 gui.train_time(update, args[-4], args[-3], args[-2], args[-1])
+            elif query.data.startswith("bici_near"):
+                args = query.data.split("_")
+                gui.bici_nearest(update, args[-2], args[-1])
+            elif query.data.startswith("bus_lines"):
+                args = query.data.split("_")
+                gui.bus_lines_menu(update, args[-2], args[-1])
+            elif query.data.startswith("bus_line"):
+                args = query.data.split("_", 4)
+                line, page = args[4].rsplit("_", 1)
+                gui.bus_line_menu(update, args[2], args[3], line, page)
+            elif query.data.startswith("results"):
+                args = query.data.split("_")
+                gui.results_menu(update, args[-2], args[-1])
             elif query.data.startswith("bus_menu"):
                 args = query.data.split("_")
                 gui.bus_menu(update, args[-1])
@@ -70,9 +77,54 @@ def button_handler(update, context):
             elif query.data.startswith("rename_fav"):
                 args = query.data.split("_")
                 gui.rename_favorite(update, args[-2], args[-1])
+            elif query.data.startswith("live"):
+                args = query.data.split("_")
+                gui.live_board(update, args[-2], args[-1])
+            elif query.data.startswith("unlive"):
+                args = query.data.split("_")
+                gui.stop_live_board(update, args[-2], args[-1])
+            elif query.data == "alerts_menu":
+                gui.alerts_menu(update)
+            elif query.data.startswith("alert_menu"):
+                args = query.data.split("_")
+                gui.alert_menu(update, args[-2], args[-1])
+            elif query.data.startswith("alert_line"):
+                args = query.data.split("_", 4)
+                gui.alert_line_menu(update, args[2], args[3], args[4])
+            elif query.data.startswith("alert_set"):
+                args = query.data.split("_", 4)
+                line, mins = args[4].rsplit("_", 1)
+                gui.set_alert(update, args[2], args[3], line, mins)
+            elif query.data.startswith("alert_del"):
+                args = query.data.split("_")
+                gui.del_alert(update, args[-1])
 
 
 def setup_handlers(dispatch):
+    from telegram import Update
+    from telegram.ext import (
+        CallbackQueryHandler,
+        ChosenInlineResultHandler,
+        CommandHandler,
+        Filters,
+        InlineQueryHandler,
+        MessageHandler,
+        TypeHandler,
+    )
+
+    import crtm.cli as cli
+    import crtm.lanes as lanes
+
+    # updates are moved to per-chat lanes and handled there
+    dispatch.add_handler(TypeHandler(Update, lanes.route), group=-2)
+    lanes.start(
+        dispatch,
+        ut.setting("lanes", lanes.N_LANES),
+        ut.setting("lane_queue", lanes.MAX_QUEUE),
+    )
+    # every update gets its time budget before any handler runs
+    dispatch.add_handler(TypeHandler(Update, cli.deadline), group=-1)
+
     start_handler = CommandHandler(
         "start", cli.start, filters=~Filters.update.edited_message
     )
@@ -149,6 +201,16 @@ def setup_handlers(dispatch):
     )
     dispatch.add_handler(donate_handler)
 
+    status_handler = CommandHandler(
+        "estado", cli.status, filters=~Filters.update.edited_message
+    )
+    dispatch.add_handler(status_handler)
+
+    alerts_handler = CommandHandler(
+        "avisos", cli.alerts, filters=~Filters.update.edited_message
+    )
+    dispatch.add_handler(alerts_handler)
+
     remove_handler = CommandHandler(
         "borrar", cli.remove, filters=~Filters.update.edited_message
     )
@@ -167,6 +229,11 @@ def setup_handlers(dispatch):
     )
     dispatch.add_handler(privacy2_handler)
 
+    location_handler = MessageHandler(
+        Filters.location & ~Filters.update.edited_message, cli.location
+    )
+    dispatch.add_handler(location_handler)
+
     text_handler = MessageHandler(
         Filters.text & ~Filters.update.edited_message, cli.text
     )
@@ -174,9 +241,9 @@ def setup_handlers(dispatch):
 
     dispatch.add_handler(CallbackQueryHandler(button_handler))
 
-    dispatcher.add_handler(InlineQueryHandler(cli.inline_query))
+    dispatch.add_handler(InlineQueryHandler(cli.inline_query))
 
-    dispatcher.add_handler(ChosenInlineResultHandler(cli.inline_message))
+    dispatch.add_handler(ChosenInlineResultHandler(cli.inline_message))
 
 
 if __name__ == "__main__":
@@ -186,33 +253,59 @@ if __name__ == "__main__":
     )
 
     if os.path.isfile(ut.FILES["cfg"]):
-        db.setup_db()
-        ut.load_config()
-
-        updater = Updater(token=ut.setting("token"), use_context=True)
-        updater.bot.set_my_commands(cli.HELP_CMD.items())
-        dispatcher = updater.dispatcher
-        setup_handlers(dispatcher)
-
-        ut.update_data(None)
-        ut.downloader_daily(updater.job_queue)
+        from telegram.ext import Updater
+
+        import crtm.cli as cli
+        import crtm.database as db
+        import crtm.ingress as ingress
+        import crtm.workers as workers
+
+        # cpu time spent before main, mostly importing modules
+        ut.STARTUP["imports"] = time.process_time()
+        with ut.phase("config"):
+            ut.load_config()
+        with ut.phase("database"):
+            db.setup_db()
+            ut.load_states()
+
+        n_workers = ut.setting("workers", 1)
+        if n_workers > 1:
+            with ut.phase("workers"):
+                updater = workers.start(setup_handlers, n_workers)
+        else:
+            with ut.phase("handlers"):
+                updater = Updater(token=ut.setting("token"), use_context=True)
+                ingress.install(updater)
+                updater.bot.set_my_commands(cli.HELP_CMD.items())
+                dispatcher = updater.dispatcher
+                setup_handlers(dispatcher)
+
+            with ut.phase("data"):
+                ut.update_data(None)
+            ut.downloader(updater.job_queue)
+            ut.state_cleaner(updater.job_queue)
+            ut.prewarmer(updater.job_queue)
+            ut.stop_poller(updater.job_queue)
+            ut.bici_snapshot(updater.job_queue)
 
         try:
-            if ut.setting("webhook"):
-                updater.start_webhook(
-                    listen=ut.setting("listen"),
-                    port=ut.setting("port"),
-                    webhook_url=(
-                        f"https://{ut.setting('ip')}"
-                    ),
-                )
-            else:
-                updater.start_polling()
+            with ut.phase("connect"):
+                if ut.setting("webhook"):
+                    updater.start_webhook(
+                        listen=ut.setting("listen"),
+                        port=ut.setting("port"),
+                        webhook_url=(f"https://{ut.setting('ip')}"),
+                    )
+                else:
+                    updater.start_polling()
             updater.idle()
         except KeyError:
             logging.error(
                 f"New setting 'webhook' required "
                 f"in {ut.FILES['cfg']}. Check README for more info."
             )
+        finally:
+            if n_workers > 1:
+                workers.stop()
     else:
         logging.error(f"File {ut.FILES['cfg']} not found.")
@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import time as tm
+from array import array
+
+MAX_AGE = 5 * 60
+SNAPSHOT = None
+COLUMNS = (
+    ("dock_bikes", "h"),
+    ("free_bases", "h"),
+    ("reservations_count", "h"),
+    ("total_bases", "h"),
+    ("light", "b"),
+    ("activate", "b"),
+)
+
+
+# status of every station as parallel columns, rows looked up by id;
+# a new snapshot replaces the previous one as a whole
+class Snapshot:
+    __slots__ = ("taken", "version", "rows", "address", "columns")
+
+    def __init__(self, stations, version):
+        self.taken = tm.time()
+        self.version = version
+        self.rows = {}
+        self.address = []
+        self.columns = {name: array(code) for name, code in COLUMNS}
+        for station in stations:
+            self.rows[int(station["id"])] = len(self.address)
+            self.address.append(station.get("address") or None)
+            for name, _ in COLUMNS:
+                self.columns[name].append(int(station.get(name) or 0))
+
+    def station(self, stop_id):
+        row = self.rows.get(int(stop_id))
+        # stations listed without address are asked for one by one
+        if row is None or self.address[row] is None:
+            return None
+        info = {name: self.columns[name][row] for name, _ in COLUMNS}
+        info["address"] = self.address[row]
+        return info
+
+    def bikes(self, stop_id):
+        row = self.rows.get(int(stop_id))
+        if row is None:
+            return 0
+        return self.columns["dock_bikes"][row]
+
+
+def update(stations, version):
+    global SNAPSHOT
+    if SNAPSHOT is not None and SNAPSHOT.version == version:
+        SNAPSHOT.taken = tm.time()
+    else:
+        SNAPSHOT = Snapshot(stations, version)
+
+
+def current():
+    if SNAPSHOT is not None and tm.time() - SNAPSHOT.taken < MAX_AGE:
+        return SNAPSHOT
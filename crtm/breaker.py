@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import logging
+import threading
+import time as tm
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+FAILURES = 5
+OPEN_FOR = 60
+BREAKERS = {}
+LOCK = threading.Lock()
+
+
+def _breaker(provider):
+    brk = BREAKERS.get(provider)
+    if brk is None:
+        brk = BREAKERS[provider] = {
+            "state": CLOSED,
+            "failures": 0,
+            "opened": 0,
+            "ok": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+    return brk
+
+
+# open breakers reject every call until OPEN_FOR elapses, then a single
+# probe is let through (half-open) to decide whether to close again
+def allow(provider):
+    with LOCK:
+        brk = _breaker(provider)
+        if brk["state"] == CLOSED:
+            return True
+        if brk["state"] == OPEN and tm.time() - brk["opened"] >= OPEN_FOR:
+            brk["state"] = HALF_OPEN
+            return True
+        brk["rejected"] += 1
+        return False
+
+
+def success(provider):
+    with LOCK:
+        brk = _breaker(provider)
+        brk["ok"] += 1
+        brk["failures"] = 0
+        if brk["state"] != CLOSED:
+            logging.info(f"Provider {provider} recovered")
+            brk["state"] = CLOSED
+
+
+def failure(provider):
+    with LOCK:
+        brk = _breaker(provider)
+        brk["failed"] += 1
+        brk["failures"] += 1
+        if brk["state"] == HALF_OPEN or (
+            brk["state"] == CLOSED and brk["failures"] >= FAILURES
+        ):
+            logging.warning(f"Provider {provider} unavailable")
+            brk["state"] = OPEN
+            brk["opened"] = tm.time()
+
+
+def call(provider, fn, *args):
+    if not allow(provider):
+        return None
+    try:
+        value = fn(*args)
+    except Exception as exc:
+        logging.warning(f"Provider {provider} failed: {exc!r}")
+        value = None
+    if value is None:
+        failure(provider)
+    else:
+        success(provider)
+    return value
+
+
+def health():
+    with LOCK:
+        return {provider: dict(brk) for provider, brk in BREAKERS.items()}
@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import os
+import threading
+import time as tm
+from multiprocessing.managers import BaseManager
+
+ARRIVAL_TTL = 20
+ERROR_TTL = 5
+PURGE_EVERY = 500
+KEEP_EXPIRED = 10 * 60
+STORE = None
+MANAGER = None
+
+
+# entries: key -> (expires, value, version), version only changes
+# when the upstream value differs from the previous one and is taken
+# from a store-wide counter, so a purged key never reuses a version
+class Store:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._ops = 0
+        self._versions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > tm.time():
+            return entry[1], entry[2]
+        return None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            old = self._data.get(key)
+            if old is not None and old[1] == value:
+                version = old[2]
+            else:
+                self._versions += 1
+                version = self._versions
+            self._data[key] = (tm.time() + ttl, value, version)
+            self._ops += 1
+            if self._ops % PURGE_EVERY == 0:
+                self._purge()
+            return version
+
+    # last value seen, even if expired, while it has not been purged
+    def stale(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            return entry[1]
+
+    def ttl(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        return entry[0] - tm.time()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def size(self):
+        return len(self._data)
+
+    def _purge(self):
+        # expired entries are kept a while so an unchanged value keeps
+        # its version
+        now = tm.time() - KEEP_EXPIRED
+        for key in [k for k, e in self._data.items() if e[0] <= now]:
+            del self._data[key]
+
+
+class StoreManager(BaseManager):
+    pass
+
+
+def _server_store():
+    global STORE
+    if STORE is None:
+        STORE = Store()
+    return STORE
+
+
+StoreManager.register("store", callable=_server_store)
+
+
+def local():
+    global STORE
+    STORE = Store()
+
+
+def serve(address, authkey):
+    global MANAGER
+    if os.path.exists(address):
+        os.remove(address)
+    MANAGER = StoreManager(address=address, authkey=authkey)
+    MANAGER.start()
+
+
+def connect(address, authkey):
+    global STORE
+    manager = StoreManager(address=address, authkey=authkey)
+    manager.connect()
+    STORE = manager.store()
+
+
+def remaining(key):
+    if STORE is None:
+        local()
+    return STORE.ttl(key)
+
+
+# cached value without fetching it and whether it is still fresh
+def peek(key):
+    if STORE is None:
+        local()
+    hit = STORE.get(key)
+    if hit is not None:
+        return hit[0], True
+    return STORE.stale(key), False
+
+
+def shutdown():
+    if MANAGER is not None:
+        MANAGER.shutdown()
+
+
+# failed fetches are remembered for ERROR_TTL seconds so a failing
+# upstream is not asked again for the same key, meanwhile the last known
+# value is returned without version
+def fetch(key, fn, *args, ttl=ARRIVAL_TTL, refresh=False):
+    if STORE is None:
+        local()
+    hit = None if refresh else STORE.get(key)
+    if hit is not None:
+        return hit
+    if STORE.get(("error", key)) is None:
+        value = fn(*args)
+        if value is not None:
+            return value, STORE.set(key, value, ttl)
+        STORE.set(("error", key), True, ERROR_TTL)
+    return STORE.stale(key), None
@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import math
+import sys
+from array import array
+
+NAN = float("nan")
+
+
+def intern(text):
+    return sys.intern(text) if text is not None else None
+
+
+# CSR adjacency: the stops of keys[k] are stops[offsets[k]:offsets[k + 1]]
+class Adjacency:
+    __slots__ = ("keys", "offsets", "stops", "_pos")
+
+    def __init__(self, mapping):
+        self.keys = [intern(key) for key in mapping]
+        self._pos = {key: pos for pos, key in enumerate(self.keys)}
+        self.offsets = array("l", [0])
+        self.stops = array("l")
+        for key in self.keys:
+            self.stops.extend(mapping[key])
+            self.offsets.append(len(self.stops))
+
+    def __getitem__(self, key):
+        pos = self._pos[key]
+        return self.stops[self.offsets[pos] : self.offsets[pos + 1]]
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# one catalogue per transport: parallel columns indexed by stop position,
+# removed stops are left as tombstones (name None)
+class Catalogue:
+    __slots__ = (
+        "index",
+        "names",
+        "ids",
+        "lat",
+        "lon",
+        "stopids",
+        "hashes",
+        "stop_lines",
+        "lines",
+        "line_names",
+        "letters",
+        "routes",
+    )
+
+    def __init__(self):
+        self.index = {}
+        self.names = []
+        self.ids = []
+        self.lat = array("d")
+        self.lon = array("d")
+        self.stopids = array("l")
+        self.hashes = array("q")
+        self.stop_lines = []
+        self.lines = Adjacency({})
+        self.line_names = {}
+        self.letters = Adjacency({})
+        self.routes = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def set(self, idx, key, name, pos=None, stopid=0, fp=0, lines=()):
+        key = intern(key)
+        lat, lon = pos if pos is not None else (NAN, NAN)
+        values = (
+            (self.names, intern(name)),
+            (self.ids, key),
+            (self.lat, lat),
+            (self.lon, lon),
+            (self.stopids, stopid),
+            (self.hashes, fp),
+            (self.stop_lines, tuple(intern(line) for line in lines)),
+        )
+        for column, value in values:
+            if idx == len(column):
+                column.append(value)
+            else:
+                column[idx] = value
+        self.index[key] = idx
+
+    def drop(self, idx):
+        del self.index[self.ids[idx]]
+        self.names[idx] = None
+        self.lat[idx] = self.lon[idx] = NAN
+        self.stop_lines[idx] = ()
+
+    def pos(self, idx):
+        if math.isnan(self.lat[idx]):
+            return None
+        return self.lat[idx], self.lon[idx]
+
+    # line -> stops and first letter -> stops, sorted by name
+    def link_lines(self):
+        lines = {}
+        letters = {}
+        for idx, name in enumerate(self.names):
+            if name is None:
+                continue
+            letters.setdefault(name[0], []).append(idx)
+            for line in self.stop_lines[idx]:
+                lines.setdefault(line, []).append(idx)
+        for mapping in (lines, letters):
+            for idxs in mapping.values():
+                idxs.sort(key=self.names.__getitem__)
+        self.lines = Adjacency(lines)
+        self.letters = Adjacency(letters)
+
+    # line -> stops in route order, lines are kept in the given order
+    def link_routes(self, lines, names):
+        self.lines = Adjacency(lines)
+        self.line_names = {intern(line): name for line, name in names.items()}
+
+    def line_letters(self, line):
+        return sorted({self.names[idx][0] for idx in self.lines[line]})
+
+    def line_stops(self, line, letter):
+        return [
+            idx for idx in self.lines[line] if self.names[idx][0] == letter
+        ]
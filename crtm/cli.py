@@ -5,12 +5,11 @@
 # Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
 # This work is licensed under the terms of the MIT license.
 
-import traceback
-
 import crtm.database as db
+import crtm.deadline as dl
 import crtm.gui as gui
+import crtm.outbox as outbox
 import crtm.utils as ut
-from telegram.error import BadRequest
 
 
 HELP_CMD = {
@@ -24,6 +23,7 @@ HELP_CMD = {
     "interurbano": "Tiempos de la parada de interurbano",
     "favoritos": "Lista de favoritos",
     "renombrar": "Renombrar un favorito",
+    "avisos": "Lista de avisos de llegada",
     "ayuda": "Lista de comandos",
     "sugerir": "Enviar una sugerencia",
     "informar": "Informar sobre un problema",
@@ -41,9 +41,14 @@ HELP = (
     f"❔ /interurbano <code>&lt;nombre/número&gt;</code> - "
     f"{HELP_CMD['interurbano']}\n"
     f"❕ <b>Nota:</b> Sólo debes dar una parte del nombre y "
-    f"te sugeriré coincidencias.\n\n"
+    f"te sugeriré coincidencias.\n"
+    f"❕ <b>Nota:</b> Si me envías tu ubicación te mostraré las "
+    f"paradas y estaciones más cercanas.\n\n"
     f"❔ /favoritos - {HELP_CMD['favoritos']}\n"
-    f"❔ /renombrar - {HELP_CMD['renombrar']}\n\n"
+    f"❔ /renombrar - {HELP_CMD['renombrar']}\n"
+    f"❔ /avisos - {HELP_CMD['avisos']}\n"
+    f"❕ <b>Nota:</b> Pulsa 🔔 Avisarme en una parada para recibir un "
+    f"aviso cuando tu línea esté cerca.\n\n"
     f"❔ /start - {HELP_CMD['start']}\n"
     f"❔ /ayuda - {HELP_CMD['ayuda']}\n"
     f"❔ /sugerir - {HELP_CMD['sugerir']}\n"
@@ -58,6 +63,11 @@ HELP = (
 )
 
 
+def deadline(update, _):
+    dl.start(ut.setting("deadline", dl.BUDGET))
+    ut.first_update()
+
+
 def start(update, _):
     uid = ut.uid(update)
     msg = HELP
@@ -125,10 +135,13 @@ def times(update, context):
                     gui.bus_time(update, cmd, index)
                     return
         if context.args:
-            msg = "Estas paradas encajan con tu búsqueda"
-            suggs = ut.stopname_matches(cmd, context.args)
-            if not suggs:
+            cid = ut.search_cursor(cmd, context.args)
+            if cid is None:
                 msg = "No existen paradas con ese criterio"
+            else:
+                msg, markup = gui.results(cid, 0)
+                ut.send(update, msg, reply_markup=markup)
+                return
         ut.send(update, msg, reply_markup=gui.markup(suggs))
 
 
@@ -148,6 +161,14 @@ def rename(update, _):
         gui.rename_menu(update)
 
 
+def alerts(update, _):
+    uid = ut.uid(update)
+    if not db.cached(uid):
+        ut.not_started(update)
+    else:
+        gui.alerts_menu(update)
+
+
 def bot_help(update, _):
     uid = ut.uid(update)
     if not db.cached(uid):
@@ -172,8 +193,8 @@ def suggest(update, _):
     if not db.cached(uid):
         ut.not_started(update)
     else:
-        if uid not in ut.STATE:
-            ut.STATE[uid] = ("suggest",)
+        if ut.get_state(uid) is None:
+            ut.set_state(uid, "suggest")
         ut.send(
             update,
             "Dime qué debería mejorar o añadir al bot, haré lo posible "
@@ -185,8 +206,8 @@ def report(update, _):
     if not db.cached(uid):
         ut.not_started(update)
     else:
-        if uid not in ut.STATE:
-            ut.STATE[uid] = ("report",)
+        if ut.get_state(uid) is None:
+            ut.set_state(uid, "report")
         ut.send(
             update,
             "Por favor, indícame el problema y los pasos para reproducirlo.",
@@ -198,22 +219,29 @@ def text(update, context):
     if not db.cached(uid):
         ut.not_started(update)
     else:
-        if uid in ut.STATE:
-            if ut.STATE[uid][0] in ["suggest", "report"]:
+        state = ut.get_state(uid)
+        if state is not None:
+            if state[0] in ["suggest", "report"]:
                 word = "de la sugerencia"
                 word2 = "Suggestion"
-                if ut.STATE[uid][0] == "report":
+                if state[0] == "report":
                     word = "del informe"
                     word2 = "Report"
                 msg = f"He tomado nota {word}. Gracias."
                 ut.send_bot(context.bot, ut.admin("id"),
-                            f"{word2}: {update.message.text}")
+                            f"{word2}: {update.message.text}",
+                            priority=outbox.ADMIN)
                 ut.store_message(update.message.text,
-                                 rep=ut.STATE[uid][0] == "report")
+                                 rep=state[0] == "report")
                 ut.send(update, msg)
             else:
-                transport, index = ut.STATE[uid][1]
-                stop, stop_id = ut.transport_info(transport, index)
+                _, transport, stop_id = state
+                try:
+                    stop, _ = ut.transport_info(
+                        transport, ut.index(transport, stop_id)
+                    )
+                except (KeyError, ValueError):
+                    stop = stop_id
                 db.rename_favorite(
                     uid, transport, stop_id, update.message.text
                 )
@@ -222,7 +250,13 @@ def text(update, context):
                     f"El nombre de la estación/parada '{stop}' "
                     f"ahora será '{update.message.text}'",
                 )
-            del ut.STATE[uid]
+            ut.del_state(uid)
+
+
+def status(update, _):
+    uid = ut.uid(update)
+    if uid == ut.admin("id"):
+        ut.send(update, "".join(ut.text_status()))
 
 
 def remove(update, _):
@@ -230,7 +264,7 @@ def remove(update, _):
     if not db.cached(uid):
         ut.not_started(update)
     else:
-        db.del_data(uid)
+        ut.del_user(uid)
         msg = (
             "Es una pena verte marchar 😢. "
             "He borrado toda la información que tenía sobre ti."
@@ -238,29 +272,47 @@ def remove(update, _):
         ut.send(update, msg)
 
 
+def inline_markup(transport, index, live=False):
+    return gui.markup(
+        [
+            ("🔃 Actualizar 🔃", f"time_inline_{transport}_{index}"),
+            gui.live_button(transport, index, live),
+        ]
+    )
+
+
 def inline_text(update, context, msg_id, callback_data):
-    kb = []
     args = callback_data.split("_")
-    msg, _ = ut.text_transport(args[-2], args[-1])
+    transport, index = args[-2], args[-1]
     gui._answer(update)
-    gui.add_upd_button(kb, callback_data)
-    try:
-        context.bot.edit_message_text(
-            "".join(msg),
-            inline_message_id=msg_id,
-            parse_mode=ut.ParseMode.HTML,
-            reply_markup=gui.markup(
-                [("🔃 Actualizar 🔃", callback_data)]
-            ),
+    owner = update.effective_user.id
+    if args[0] == "live":
+        ut.start_live(
+            context.bot,
+            owner,
+            msg_id,
+            transport,
+            index,
+            inline_markup(transport, index, live=True),
+            inline_markup(transport, index),
+        )
+    else:
+        if args[0] == "unlive":
+            ut.stop_live(owner)
+        ut.show_pending(
+            context.bot,
+            msg_id,
+            transport,
+            index,
+            inline_markup(transport, index),
+        )
+        ut.show_live(
+            context.bot,
+            msg_id,
+            transport,
+            index,
+            inline_markup(transport, index),
         )
-    except BadRequest as br:
-        if not str(br).startswith("Message is not modified:"):
-            print(
-                f"***  Exception caught in edit "
-                f"({update.effective_message.chat.id}): ",
-                br,
-            )
-            traceback.print_stack()
 
 
 def inline_message(update, context):
@@ -270,20 +322,81 @@ def inline_message(update, context):
     )
 
 
+def location(update, _):
+    uid = ut.uid(update)
+    if not db.cached(uid):
+        ut.not_started(update)
+    else:
+        loc = update.message.location
+        msg = "No hay paradas/estaciones cerca de tu ubicación"
+        suggs = []
+        stops = ut.nearest_stops(loc.latitude, loc.longitude)
+        if stops:
+            msg = "Estas son las paradas/estaciones más cercanas"
+            for transport, index, dist in stops:
+                stop, callback_data = ut.stop_data(transport, index)
+                suggs.append(
+                    (
+                        f"{ut.TRANSPORT_EMOJI[transport]} {stop} "
+                        f"({ut.text_distance(dist)})",
+                        callback_data,
+                    )
+                )
+            suggs.append(
+                (
+                    f"🚲 Estaciones con {ut.BICI_MIN} bicis o más",
+                    f"bici_near_{loc.latitude:.5f}_{loc.longitude:.5f}",
+                )
+            )
+        ut.send(update, msg, reply_markup=gui.markup(suggs))
+
+
+def inline_prefix(transport):
+    for cmd, (trans, stype) in ut.CMD_TRANS.items():
+        if cmd != "type_bus" and trans == transport:
+            if transport == "bici":
+                return f"estadísticas de {stype}"
+            return f"tiempos en {stype}"
+
+
+def inline_nearest(update, location, args):
+    transport = None
+    if args:
+        cmd = ut.normalize(args[0]).lower()
+        if cmd not in ut.CMD_TRANS or cmd == "type_bus":
+            return
+        transport = ut.CMD_TRANS[cmd][0]
+    results = []
+    stops = ut.nearest_stops(
+        location.latitude, location.longitude, transport=transport
+    )
+    for trans, index, dist in stops:
+        stop, callback_data = ut.stop_data(trans, index, inline=True)
+        results.append(
+            ut.result(
+                trans,
+                callback_data,
+                f"{inline_prefix(trans)} {stop} · {ut.text_distance(dist)}",
+            )
+        )
+    update.inline_query.answer(results, cache_time=30, is_personal=True)
+
+
 def inline_query(update, _):
     query = update.inline_query.query
+    args = query.split()
+    location = update.inline_query.location
+    if location is not None and len(args) <= 1:
+        inline_nearest(update, location, args)
+        return
     if query == "":
         return
-    args = query.split()
     cmd = ut.normalize(args[0]).lower()
     results = []
     if len(args) > 1:
         if cmd in ut.CMD_TRANS:
-            transport, stype = ut.CMD_TRANS[cmd]
-            if transport == "bici":
-                msg = f"estadísticas de {stype}"
-            else:
-                msg = f"tiempos en {stype}"
+            transport, _ = ut.CMD_TRANS[cmd]
+            msg = inline_prefix(transport)
             if ut.is_bus(transport) and ut.is_int(args[1]):
                 match, index = ut.stopnumber_match(transport, args[1])
                 if match:
@@ -3,41 +3,261 @@
 # Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
 # This work is licensed under the terms of the MIT license.
 
+import logging
 import sqlite3 as sql
 from contextlib import closing
 
 import crtm.utils as ut
 
 
-def setup_db():
-    with closing(sql.connect(ut.FILES["db"])) as db:
-        with closing(db.cursor()) as cur:
-            cur.executescript(
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    uid INTEGER PRIMARY KEY
-                );
+BATCH = 5000
+CODES = {"bici": 1, "metro": 2, "cerc": 3, "emt": 4, "urb": 5}
+TYPES = {code: transport for transport, code in CODES.items()}
+
+
+def connect():
+    db = sql.connect(ut.FILES["db"])
+    db.execute("PRAGMA foreign_keys = ON")
+    return db
+
+
+# schema as it was before migrations were versioned
+def _baseline(db):
+    for stmt in (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            uid INTEGER PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transports (
+            type TEXT,
+            PRIMARY KEY (type)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS favorites (
+            uid INTEGER,
+            type TEXT,
+            stop_id TEXT,
+            stop TEXT,
+            FOREIGN KEY (uid) REFERENCES users(uid),
+            FOREIGN KEY (type) REFERENCES transports(type),
+            PRIMARY KEY (uid, type, stop_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY,
+            uid INTEGER,
+            type TEXT,
+            stop_id TEXT,
+            stop TEXT,
+            line TEXT,
+            minutes INTEGER,
+            expires INTEGER,
+            FOREIGN KEY (uid) REFERENCES users(uid)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS states (
+            uid INTEGER PRIMARY KEY,
+            state TEXT,
+            type TEXT,
+            stop_id TEXT,
+            expires INTEGER
+        )
+        """,
+    ):
+        db.execute(stmt)
+
+
+# favorites are copied in short batches before the version step while
+# triggers mirror the writes done meanwhile, so an instance still running
+# the old schema keeps serving until the swap; rerunning an interrupted
+# copy just continues it. Default names are cleared once the catalogue
+# is loaded (clear_default_names)
+def _copy_favorites(db):
+    db.execute("BEGIN")
+    for stmt in (
+        """
+        CREATE TABLE IF NOT EXISTS transports_new (
+            code INTEGER PRIMARY KEY,
+            type TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS favorites_new (
+            uid INTEGER NOT NULL
+                REFERENCES users(uid) ON DELETE CASCADE,
+            type INTEGER NOT NULL REFERENCES transports_new(code),
+            stop_id TEXT NOT NULL,
+            stop TEXT,
+            PRIMARY KEY (uid, type, stop_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS favorites_copy_insert
+        AFTER INSERT ON favorites
+        BEGIN
+            INSERT OR REPLACE INTO favorites_new
+            SELECT NEW.uid, code, NEW.stop_id, NEW.stop
+            FROM transports_new WHERE type = NEW.type;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS favorites_copy_update
+        AFTER UPDATE ON favorites
+        BEGIN
+            INSERT OR REPLACE INTO favorites_new
+            SELECT NEW.uid, code, NEW.stop_id, NEW.stop
+            FROM transports_new WHERE type = NEW.type;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS favorites_copy_delete
+        AFTER DELETE ON favorites
+        BEGIN
+            DELETE FROM favorites_new
+            WHERE uid = OLD.uid
+                AND type = (
+                    SELECT code FROM transports_new WHERE type = OLD.type
+                )
+                AND stop_id = OLD.stop_id;
+        END
+        """,
+    ):
+        db.execute(stmt)
+    db.executemany(
+        "INSERT OR IGNORE INTO transports_new (code, type) VALUES (?, ?)",
+        [(code, transport) for transport, code in CODES.items()],
+    )
+    db.execute("COMMIT")
+    last = 0
+    while True:
+        db.execute("BEGIN")
+        top = db.execute(
+            "SELECT max(rowid) FROM ("
+            "SELECT rowid FROM favorites WHERE rowid > ? "
+            "ORDER BY rowid LIMIT ?"
+            ")",
+            [last, BATCH],
+        ).fetchone()[0]
+        if top is None:
+            db.execute("COMMIT")
+            break
+        db.execute(
+            "INSERT OR IGNORE INTO favorites_new "
+            "SELECT f.uid, t.code, f.stop_id, f.stop "
+            "FROM favorites f JOIN transports_new t ON t.type = f.type "
+            "WHERE f.rowid > ? AND f.rowid <= ? "
+            "AND f.uid IN (SELECT uid FROM users)",
+            [last, top],
+        )
+        db.execute("COMMIT")
+        last = top
+
+
+# the swap runs in the version transaction, so a crash leaves either the
+# old schema (and the copy is resumed) or the new one
+def _compact_favorites(db):
+    for stmt in (
+        "DROP TRIGGER favorites_copy_insert",
+        "DROP TRIGGER favorites_copy_update",
+        "DROP TRIGGER favorites_copy_delete",
+        "DROP TABLE favorites",
+        "DROP TABLE transports",
+        "ALTER TABLE transports_new RENAME TO transports",
+        "ALTER TABLE favorites_new RENAME TO favorites",
+    ):
+        db.execute(stmt)
+
 
-                CREATE TABLE IF NOT EXISTS transports (
-                    type TEXT,
-                    PRIMARY KEY (type)
-                );
+# alerts and states are small, they are rebuilt inside the version
+# transaction; alerts store the transport code like favorites
+def _cascade_user_data(db):
+    for stmt in (
+        """
+        CREATE TABLE alerts_new (
+            id INTEGER PRIMARY KEY,
+            uid INTEGER NOT NULL
+                REFERENCES users(uid) ON DELETE CASCADE,
+            type INTEGER NOT NULL REFERENCES transports(code),
+            stop_id TEXT,
+            stop TEXT,
+            line TEXT,
+            minutes INTEGER,
+            expires INTEGER
+        )
+        """,
+        """
+        INSERT INTO alerts_new
+        SELECT a.id, a.uid, t.code, a.stop_id, a.stop, a.line, a.minutes,
+            a.expires
+        FROM alerts a JOIN transports t ON t.type = a.type
+        WHERE a.uid IN (SELECT uid FROM users)
+        """,
+        "DROP TABLE alerts",
+        "ALTER TABLE alerts_new RENAME TO alerts",
+        "CREATE INDEX alerts_uid ON alerts (uid)",
+        "CREATE INDEX alerts_expires ON alerts (expires)",
+        """
+        CREATE TABLE states_new (
+            uid INTEGER PRIMARY KEY
+                REFERENCES users(uid) ON DELETE CASCADE,
+            state TEXT,
+            type TEXT,
+            stop_id TEXT,
+            expires INTEGER
+        )
+        """,
+        """
+        INSERT INTO states_new
+        SELECT uid, state, type, stop_id, expires
+        FROM states WHERE uid IN (SELECT uid FROM users)
+        """,
+        "DROP TABLE states",
+        "ALTER TABLE states_new RENAME TO states",
+    ):
+        db.execute(stmt)
 
-                CREATE TABLE IF NOT EXISTS favorites (
-                    uid INTEGER,
-                    type TEXT,
-                    stop_id TEXT,
-                    stop TEXT,
-                    FOREIGN KEY (uid) REFERENCES users(uid),
-                    FOREIGN KEY (type) REFERENCES transports(type),
-                    PRIMARY KEY (uid, type, stop_id)
-                );
-                """
+
+# MIGRATIONS[n] takes the database from user_version n to n + 1, the
+# optional first function runs before the version transaction and must
+# be safe to rerun
+MIGRATIONS = [
+    (None, _baseline),
+    (_copy_favorites, _compact_favorites),
+    (None, _cascade_user_data),
+]
+
+
+def setup_db():
+    with closing(sql.connect(ut.FILES["db"])) as db:
+        db.isolation_level = None
+        db.execute("PRAGMA journal_mode = WAL")
+        # tables are rebuilt, references are checked once at the end
+        db.execute("PRAGMA foreign_keys = OFF")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version + 1, len(MIGRATIONS) + 1):
+            logging.info(f"Migrating database to version {number}")
+            online, step = MIGRATIONS[number - 1]
+            if online is not None:
+                online(db)
+            db.execute("BEGIN")
+            step(db)
+            db.execute(f"PRAGMA user_version = {number}")
+            db.execute("COMMIT")
+        for table, rowid, parent, _ in db.execute(
+            "PRAGMA foreign_key_check"
+        ):
+            logging.warning(
+                f"Row {rowid} of {table} references a missing {parent}"
             )
 
 
 def cached(uid):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute(
                 "SELECT EXISTS (SELECT 1 FROM users WHERE uid = ?)",
@@ -47,31 +267,34 @@ def cached(uid):
 
 
 def add_user(uid):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute("INSERT INTO users (uid) VALUES (?)", [uid])
             db.commit()
 
 
 def del_user(uid):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute("DELETE FROM users WHERE uid = ?", [uid])
             db.commit()
 
 
 def favorites(uid):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute(
                 "SELECT type, stop_id, stop FROM favorites WHERE uid = ?",
                 [uid],
             )
-            return cur.fetchall()
+            return [
+                (TYPES[code], stop_id, stop)
+                for code, stop_id, stop in cur.fetchall()
+            ]
 
 
 def favorite_cached(uid, transport, stop_id):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute(
                 "SELECT EXISTS ("
@@ -79,53 +302,201 @@ def favorite_cached(uid, transport, stop_id):
                 "FROM favorites "
                 "WHERE uid = ? AND type = ? AND stop_id = ?"
                 ")",
-                [uid, transport, stop_id],
+                [uid, CODES[transport], stop_id],
             )
             return cur.fetchone()[0]
 
 
-def add_favorite(uid, transport, stop_id, stop):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+# the stop name is only stored once the favorite is renamed
+def add_favorite(uid, transport, stop_id):
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
-            cur.execute(
-                "INSERT OR IGNORE INTO transports (type) VALUES (?)",
-                [transport],
-            )
             cur.execute(
                 "INSERT OR IGNORE INTO favorites "
-                "(uid, type, stop_id, stop) "
-                "VALUES (?, ?, ?, ?)",
-                [uid, transport, stop_id, stop],
+                "(uid, type, stop_id) "
+                "VALUES (?, ?, ?)",
+                [uid, CODES[transport], stop_id],
             )
             db.commit()
 
 
 def rename_favorite(uid, transport, stop_id, stop):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute(
                 "UPDATE favorites "
                 "SET stop = ? "
                 "WHERE uid = ? AND type = ? AND stop_id = ?",
-                [stop, uid, transport, stop_id],
+                [stop, uid, CODES[transport], stop_id],
             )
             db.commit()
 
 
 def del_favorite(uid, transport, stop_id):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
             cur.execute(
                 "DELETE FROM favorites "
                 "WHERE uid = ? AND type = ? AND stop_id = ?",
-                [uid, transport, stop_id],
+                [uid, CODES[transport], stop_id],
             )
             db.commit()
 
 
-def del_data(uid):
-    with closing(sql.connect(ut.FILES["db"])) as db:
+# favorites saved before names were optional store the stop name, it is
+# cleared when it still matches the catalogue so renames keep working
+def clear_default_names(transport, names):
+    code = CODES[transport]
+    with closing(connect()) as db:
         with closing(db.cursor()) as cur:
-            cur.execute("DELETE FROM favorites WHERE uid = ?", [uid])
-            cur.execute("DELETE FROM users WHERE uid = ?", [uid])
+            cur.execute(
+                "SELECT uid, stop_id, stop FROM favorites "
+                "WHERE type = ? AND stop IS NOT NULL",
+                [code],
+            )
+            default = [
+                (uid, code, stop_id)
+                for uid, stop_id, stop in cur.fetchall()
+                if names.get(stop_id) == stop
+            ]
+            cur.executemany(
+                "UPDATE favorites SET stop = NULL "
+                "WHERE uid = ? AND type = ? AND stop_id = ?",
+                default,
+            )
+            db.commit()
+
+
+# favorites saved with an alias id of a stop are moved to its canonical
+# id, duplicates left behind are removed
+def canonical_favorites(transport, canonical):
+    code = CODES[transport]
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.executemany(
+                "UPDATE OR IGNORE favorites "
+                "SET stop_id = ? "
+                "WHERE type = ? AND stop_id = ?",
+                [(cid, code, alias) for alias, cid in canonical.items()],
+            )
+            # keep the custom name of a duplicate if the other has none
+            cur.executemany(
+                "UPDATE favorites "
+                "SET stop = ("
+                "SELECT old.stop FROM favorites old "
+                "WHERE old.uid = favorites.uid "
+                "AND old.type = favorites.type AND old.stop_id = ?"
+                ") "
+                "WHERE type = ? AND stop_id = ? AND stop IS NULL",
+                [(alias, code, cid) for alias, cid in canonical.items()],
+            )
+            cur.executemany(
+                "DELETE FROM favorites WHERE type = ? AND stop_id = ?",
+                [(code, alias) for alias in canonical],
+            )
+            db.commit()
+
+
+def states(now):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "SELECT uid, expires, state, type, stop_id "
+                "FROM states WHERE expires > ?",
+                [now],
+            )
+            return cur.fetchall()
+
+
+def set_state(uid, expires, state, transport, stop_id):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO states "
+                "(uid, expires, state, type, stop_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [uid, expires, state, transport, stop_id],
+            )
+            db.commit()
+
+
+def del_state(uid):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("DELETE FROM states WHERE uid = ?", [uid])
+            db.commit()
+
+
+def del_expired_states(now):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("DELETE FROM states WHERE expires <= ?", [now])
+            db.commit()
+
+
+def alerts(now):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "SELECT id, uid, type, stop_id, stop, line, minutes, expires "
+                "FROM alerts WHERE expires > ?",
+                [now],
+            )
+            return [
+                (aid, uid, TYPES[code], *rest)
+                for aid, uid, code, *rest in cur.fetchall()
+            ]
+
+
+def user_alerts(uid):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "SELECT id, type, stop_id, stop, line, minutes "
+                "FROM alerts WHERE uid = ?",
+                [uid],
+            )
+            return [
+                (aid, TYPES[code], *rest)
+                for aid, code, *rest in cur.fetchall()
+            ]
+
+
+def add_alert(uid, transport, stop_id, stop, line, minutes, expires):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "INSERT INTO alerts "
+                "(uid, type, stop_id, stop, line, minutes, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [uid, CODES[transport], stop_id, stop, line, minutes, expires],
+            )
+            db.commit()
+            return cur.lastrowid
+
+
+def alert(uid, aid):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "SELECT type, stop_id FROM alerts WHERE uid = ? AND id = ?",
+                [uid, aid],
+            )
+            row = cur.fetchone()
+            if row is not None:
+                row = (TYPES[row[0]], row[1])
+            return row
+
+
+def del_alert(aid):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("DELETE FROM alerts WHERE id = ?", [aid])
+            db.commit()
+
+
+def del_expired_alerts(now):
+    with closing(connect()) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("DELETE FROM alerts WHERE expires <= ?", [now])
             db.commit()
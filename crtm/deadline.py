@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import logging
+import threading
+import time as tm
+from concurrent import futures
+
+BUDGET = 8
+WORKERS = 16
+QUEUED = 16  # calls waiting for a free thread
+LOCAL = threading.local()
+POOL = futures.ThreadPoolExecutor(WORKERS, thread_name_prefix="upstream")
+# hung upstream calls keep their thread, new calls are refused once all
+# threads and queue slots are taken instead of piling up
+SLOTS = threading.BoundedSemaphore(WORKERS + QUEUED)
+
+
+# the deadline belongs to the thread handling the update, threads
+# without one (jobs) get a full budget for each call
+def start(budget=BUDGET):
+    LOCAL.deadline = tm.monotonic() + budget
+
+
+def remaining(default=BUDGET):
+    deadline = getattr(LOCAL, "deadline", None)
+    if deadline is None:
+        return default
+    return max(0, deadline - tm.monotonic())
+
+
+# calls fn in the upstream pool, returning default if it does not finish
+# before the deadline; the call is left running in the background
+def run(fn, *args, default=None):
+    left = remaining()
+    if left <= 0:
+        return default
+    if not SLOTS.acquire(blocking=False):
+        logging.warning(f"Upstream pool full calling {fn.__name__}{args}")
+        return default
+    future = POOL.submit(_within, tm.monotonic() + left, fn, args)
+    future.add_done_callback(lambda _: SLOTS.release())
+    try:
+        return future.result(timeout=left)
+    except futures.TimeoutError:
+        logging.warning(f"Deadline exceeded calling {fn.__name__}{args}")
+        return default
+
+
+# the pool thread gets the caller's deadline so fn can size its timeouts
+def _within(deadline, fn, args):
+    LOCAL.deadline = deadline
+    try:
+        return fn(*args)
+    finally:
+        del LOCAL.deadline
@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import heapq
+import math
+
+CELL = 0.005  # degrees, ~550m of latitude in Madrid
+EARTH = 6371000
+MAX_RINGS = 40
+GRID = {}  # (row, col) -> [(lat, lon, transport, index)]
+
+
+def coords(item, lat, lon):
+    try:
+        return [round(float(item[lat]), 6), round(float(item[lon]), 6)]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# geojson point, longitude first
+def geojson(item):
+    try:
+        lon, lat = item["geometry"]["coordinates"][:2]
+        return [round(float(lat), 6), round(float(lon), 6)]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def cell(lat, lon):
+    return int(math.floor(lat / CELL)), int(math.floor(lon / CELL))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # equirectangular approximation, accurate enough at city scale
+    x = math.radians(lon2 - lon1) * math.cos(math.radians(lat1 + lat2) / 2)
+    y = math.radians(lat2 - lat1)
+    return EARTH * math.hypot(x, y)
+
+
+def build(points):
+    GRID.clear()
+    for lat, lon, transport, index in points:
+        GRID.setdefault(cell(lat, lon), []).append(
+            (lat, lon, transport, index)
+        )
+
+
+def add(lat, lon, transport, index):
+    GRID.setdefault(cell(lat, lon), []).append((lat, lon, transport, index))
+
+
+def remove(lat, lon, transport, index):
+    key = cell(lat, lon)
+    points = [
+        p for p in GRID.get(key, ()) if p[2] != transport or p[3] != index
+    ]
+    if points:
+        GRID[key] = points
+    else:
+        GRID.pop(key, None)
+
+
+def _ring(row, col, radius):
+    if radius == 0:
+        yield row, col
+        return
+    for dc in range(-radius, radius + 1):
+        yield row - radius, col + dc
+        yield row + radius, col + dc
+    for dr in range(-radius + 1, radius):
+        yield row + dr, col - radius
+        yield row + dr, col + radius
+
+
+# visits grid rings around the point until the n-th best distance is
+# closer than anything an unvisited ring could hold
+def nearest(lat, lon, n, accept=None):
+    row, col = cell(lat, lon)
+    ring_width = CELL * math.radians(1) * EARTH * 0.75
+    best = []  # max-heap through negated distances
+    for radius in range(MAX_RINGS):
+        if len(best) >= n and -best[0][0] < (radius - 1) * ring_width:
+            break
+        for key in _ring(row, col, radius):
+            for plat, plon, transport, index in GRID.get(key, ()):
+                if accept is not None and not accept(transport, index):
+                    continue
+                dist = distance(lat, lon, plat, plon)
+                entry = (-dist, transport, index)
+                if len(best) < n:
+                    heapq.heappush(best, entry)
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, entry)
+    return [(t, i, -d) for d, t, i in sorted(best, reverse=True)]
@@ -0,0 +1,285 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import csv
+import io
+import logging
+import os
+import sqlite3 as sql
+import threading
+import zipfile
+from contextlib import closing
+from datetime import date
+
+import crtm.database as db
+import crtm.utils as ut
+
+DEPARTURES = 3  # per line and headsign
+HORIZON = 3 * 60 * 60
+DAY = 24 * 60 * 60
+WEEKDAYS = (
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+)
+READER = None
+SERVICES = {}  # (transport, service) -> (first day ordinal, bitset)
+FEEDS = {}  # transport -> mtime of the feed loaded
+LOCK = threading.Lock()
+
+
+def setup(conn):
+    conn.executescript(
+        """
+        PRAGMA journal_mode = WAL;
+
+        CREATE TABLE IF NOT EXISTS departures (
+            transport INTEGER,
+            stop TEXT,
+            time INTEGER,
+            service INTEGER,
+            line TEXT,
+            headsign TEXT,
+            PRIMARY KEY (transport, stop, time, service, line, headsign)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS services (
+            transport INTEGER,
+            service INTEGER,
+            start INTEGER,
+            days BLOB,
+            PRIMARY KEY (transport, service)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS feeds (
+            transport INTEGER PRIMARY KEY,
+            mtime REAL
+        );
+        """
+    )
+
+
+def rows(feed, name):
+    if name not in feed.namelist():
+        return
+    with feed.open(name) as f:
+        yield from csv.DictReader(io.TextIOWrapper(f, "utf-8-sig"))
+
+
+def seconds(text):
+    hours, minutes, secs = text.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(secs)
+
+
+def ordinal(text):
+    return date(int(text[:4]), int(text[4:6]), int(text[6:8])).toordinal()
+
+
+# one bit per day from the first day the service may run
+def bitsets(feed, services):
+    weekly = {}
+    for row in rows(feed, "calendar.txt"):
+        if row["service_id"] in services:
+            weekly[row["service_id"]] = (
+                ordinal(row["start_date"]),
+                ordinal(row["end_date"]),
+                [row[day] == "1" for day in WEEKDAYS],
+            )
+    exceptions = {}
+    for row in rows(feed, "calendar_dates.txt"):
+        if row["service_id"] in services:
+            exceptions.setdefault(row["service_id"], []).append(
+                (ordinal(row["date"]), row["exception_type"] == "1")
+            )
+    for service_id, sid in services.items():
+        days = [day for day, _ in exceptions.get(service_id, ())]
+        if service_id in weekly:
+            days.extend(weekly[service_id][:2])
+        if not days:
+            continue
+        start = min(days)
+        bits = bytearray((max(days) - start) // 8 + 1)
+        if service_id in weekly:
+            first, last, weekdays = weekly[service_id]
+            for day in range(first, last + 1):
+                if weekdays[date.fromordinal(day).weekday()]:
+                    bits[(day - start) >> 3] |= 1 << ((day - start) & 7)
+        for day, added in exceptions.get(service_id, ()):
+            if added:
+                bits[(day - start) >> 3] |= 1 << ((day - start) & 7)
+            else:
+                bits[(day - start) >> 3] &= ~(1 << ((day - start) & 7))
+        yield sid, start, bytes(bits)
+
+
+def ingest(transport, path):
+    code = db.CODES[transport]
+    with zipfile.ZipFile(path) as feed, closing(
+        sql.connect(ut.FILES["gtfs"])
+    ) as conn:
+        setup(conn)
+        routes = {
+            row["route_id"]: row["route_short_name"]
+            or row["route_long_name"]
+            for row in rows(feed, "routes.txt")
+        }
+        # platforms are folded into their station
+        stops = {}
+        parents = {}
+        for row in rows(feed, "stops.txt"):
+            stops[row["stop_id"]] = row.get("stop_code") or row["stop_id"]
+            if row.get("parent_station"):
+                parents[row["stop_id"]] = row["parent_station"]
+        for stop_id, parent in parents.items():
+            stops[stop_id] = stops.get(parent, stops[stop_id])
+        services = {}
+        trips = {}
+        for row in rows(feed, "trips.txt"):
+            sid = services.setdefault(row["service_id"], len(services))
+            trips[row["trip_id"]] = (
+                sid,
+                routes.get(row["route_id"], ""),
+                row.get("trip_headsign", ""),
+            )
+        conn.execute("DELETE FROM departures WHERE transport = ?", [code])
+        conn.execute("DELETE FROM services WHERE transport = ?", [code])
+        conn.execute(
+            "CREATE TEMP TABLE staging "
+            "(stop TEXT, time INTEGER, service INTEGER, "
+            "line TEXT, headsign TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO staging VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    stops.get(row["stop_id"], row["stop_id"]),
+                    seconds(row["departure_time"] or row["arrival_time"]),
+                    *trips[row["trip_id"]],
+                )
+                for row in rows(feed, "stop_times.txt")
+                if row["trip_id"] in trips
+                and (row["departure_time"] or row["arrival_time"])
+            ),
+        )
+        # rows are written in key order so each stop is stored contiguously
+        conn.execute(
+            "INSERT OR IGNORE INTO departures "
+            "SELECT ?, stop, time, service, line, headsign FROM staging "
+            "ORDER BY stop, time",
+            [code],
+        )
+        conn.execute("DROP TABLE staging")
+        conn.executemany(
+            "INSERT INTO services VALUES (?, ?, ?, ?)",
+            (
+                (code, sid, start, bits)
+                for sid, start, bits in bitsets(feed, services)
+            ),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO feeds VALUES (?, ?)",
+            [code, os.path.getmtime(path)],
+        )
+        conn.commit()
+    logging.info(f"GTFS feed of {transport} loaded from {path}")
+
+
+# ingests the configured feeds that changed since they were loaded
+def refresh():
+    feeds = ut.setting("gtfs", {})
+    if not feeds:
+        return
+    with closing(sql.connect(ut.FILES["gtfs"])) as conn:
+        setup(conn)
+        loaded = dict(conn.execute("SELECT transport, mtime FROM feeds"))
+    for transport, path in feeds.items():
+        if not os.path.isfile(path):
+            logging.warning(f"GTFS feed {path} not found")
+            continue
+        if loaded.get(db.CODES[transport]) != os.path.getmtime(path):
+            ingest(transport, path)
+    if changed():
+        load()
+
+
+# true when another process ingested feeds after they were loaded here
+def changed():
+    if not os.path.isfile(ut.FILES["gtfs"]):
+        return False
+    with closing(sql.connect(ut.FILES["gtfs"])) as conn:
+        try:
+            feeds = dict(conn.execute("SELECT transport, mtime FROM feeds"))
+        except sql.OperationalError:
+            return False
+    return READER is None or feeds != FEEDS
+
+
+def load():
+    global READER
+    if not os.path.isfile(ut.FILES["gtfs"]):
+        return
+    with LOCK:
+        if READER is not None:
+            READER.close()
+        READER = sql.connect(ut.FILES["gtfs"], check_same_thread=False)
+        READER.create_function("running", 3, running, deterministic=True)
+        SERVICES.clear()
+        FEEDS.clear()
+        try:
+            for transport, service, start, days in READER.execute(
+                "SELECT transport, service, start, days FROM services"
+            ):
+                SERVICES[(transport, service)] = (start, days)
+            FEEDS.update(READER.execute("SELECT transport, mtime FROM feeds"))
+        except sql.OperationalError:
+            pass
+
+
+def running(code, service, day):
+    entry = SERVICES.get((code, service))
+    if entry is None:
+        return False
+    offset = day - entry[0]
+    if offset < 0 or offset >> 3 >= len(entry[1]):
+        return False
+    return bool(entry[1][offset >> 3] >> (offset & 7) & 1)
+
+
+# next scheduled departures from stop, as (seconds from now, line,
+# headsign); trips of yesterday's services past midnight are included
+def next_departures(transport, stop_id, now):
+    if READER is None:
+        return []
+    code = db.CODES[transport]
+    today = now.date().toordinal()
+    secs = now.hour * 3600 + now.minute * 60 + now.second
+    found = []
+    with LOCK:
+        for day, since in ((today - 1, secs + DAY), (today, secs)):
+            # services not running that day are skipped by sqlite, so
+            # busy stops never run out of rows before today's departures
+            for time, line, headsign in READER.execute(
+                "SELECT time, line, headsign FROM departures "
+                "WHERE transport = ? AND stop = ? AND time BETWEEN ? AND ? "
+                "AND running(transport, service, ?) "
+                "ORDER BY time",
+                [code, stop_id, since, since + HORIZON, day],
+            ):
+                found.append((time - since, line, headsign))
+    found.sort()
+    shown = {}
+    for wait, line, headsign in found:
+        times = shown.setdefault((line, headsign), [])
+        if len(times) < DEPARTURES:
+            times.append(wait)
+    return [
+        (wait, line, headsign)
+        for (line, headsign), times in shown.items()
+        for wait in times
+    ]
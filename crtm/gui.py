@@ -38,6 +38,34 @@ def markup(buttons):
         )
 
 
+# results_<cursor>_<page> -> time_cli_<transport>_<index>
+def results(cid, page):
+    data = ut.cursor(cid)
+    if data is None:
+        return "La búsqueda ha caducado, vuelve a realizarla", None
+    transport, idxs = data
+    size = ut.STOPS_ROWS
+    total = max(1, -(-len(idxs) // size))
+    page = min(page, total - 1)
+    kb = [
+        button([ut.stop_data(transport, idx)])
+        for idx in idxs[page * size : (page + 1) * size]
+    ]
+    nav = page_buttons(f"results_{cid}", page, total)
+    if nav:
+        kb.append(button(nav))
+    msg = "Estas paradas encajan con tu búsqueda"
+    if total > 1:
+        msg = f"{msg} ({page + 1}/{total})"
+    return msg, InlineKeyboardMarkup(kb)
+
+
+def results_menu(update, cid, page):
+    _answer(update)
+    msg, markup = results(cid, int(page))
+    ut.edit(update, msg, markup)
+
+
 def main_menu(update):
     _answer(update)
     kb = [
@@ -59,7 +87,12 @@ def main_menu(update):
                 ("🚌 Interurbano 🚌", "bus_menu_urb"),
             ]
         ),
-        button([("❤️ Favoritos ❤️", "favorites_menu")]),
+        button(
+            [
+                ("❤️ Favoritos ❤️", "favorites_menu"),
+                ("🔔 Avisos 🔔", "alerts_menu"),
+            ]
+        ),
     ]
     resp = ut.send
     if update.callback_query is not None:
@@ -84,7 +117,7 @@ def weather_menu(update):
 # train_menu_<transport> -> line_menu_<transport>_<line>
 def train_menu(update, transport):
     _answer(update)
-    keys = list(ut.DATA["proc"][transport]["lines"].keys())
+    keys = list(ut.DATA["proc"][transport].lines)
     kb = []
     sort_fn = ut.sort_lines
     if transport == "cerc":
@@ -112,9 +145,9 @@ def train_menu(update, transport):
 def train_line_menu(update, transport, line):
     _answer(update)
     if line == "A-Z":
-        keys = sorted(list(ut.DATA["proc"][transport]["stops"].keys()))
+        keys = list(ut.DATA["proc"][transport].letters)
     else:
-        keys = list(ut.DATA["proc"][transport]["lines"][line].keys())
+        keys = ut.DATA["proc"][transport].line_letters(line)
     kb = []
     for letters in ut.chunk(sorted(keys)):
         kb.append(
@@ -151,17 +184,15 @@ def train_line_menu(update, transport, line):
 def train_station_menu(update, transport, line, letter):
     _answer(update)
     if line == "A-Z":
-        idxs = ut.DATA["proc"][transport]["stops"][letter]
+        idxs = ut.DATA["proc"][transport].letters[letter]
     else:
-        idxs = ut.DATA["proc"][transport]["lines"][line][letter]
-    kb = []
-    stations = {}
-    for idx in idxs:
-        stop, _ = ut.transport_info(transport, idx)
-        stations[stop] = idx
+        idxs = ut.DATA["proc"][transport].line_stops(line, letter)
+    names = ut.DATA["proc"][transport].names
     kb = [
-        button([(stop, f"time_train_{transport}_{line}_{letter}_{idx}")])
-        for stop, idx in sorted(stations.items())
+        button(
+            [(names[idx], f"time_train_{transport}_{line}_{letter}_{idx}")]
+        )
+        for idx in idxs
     ]
     kb.append(
         button(
@@ -185,9 +216,12 @@ def train_station_menu(update, transport, line, letter):
 # time_train_<transport>_<line>_<letter>_<index>
 def train_time(update, transport, line, letter, index):
     kb = []
-    msg, stop_id = ut.text_transport(transport, index)
     _answer(update)
+    show_pending(update, transport, index)
+    msg, stop_id, key = ut.text_transport(transport, index)
     add_upd_button(kb, f"time_train_{transport}_{line}_{letter}_{index}")
+    add_live_button(kb, transport, index)
+    add_alert_button(kb, transport, index)
     kb.append(
         button(
             [
@@ -202,16 +236,63 @@ def train_time(update, transport, line, letter, index):
         )
     )
     add_fav_button(kb, update, transport, index, stop_id)
-    resp = ut.send
+    show_board(update, msg, kb, key)
+
+
+# callbacks are answered first and the message shows the last known
+# board (or a loading text) until the arrivals are fetched
+def show_pending(update, transport, index):
+    query = update.callback_query
+    if query is not None:
+        ut.show_pending(
+            query.bot,
+            ut.message_key(update),
+            transport,
+            index,
+            query.message.reply_markup,
+        )
+
+
+def show_board(update, msg, keyboard, key):
     if update.callback_query is not None:
-        resp = ut.edit
-    resp(update, "".join(msg), reply_markup=InlineKeyboardMarkup(kb))
+        ut.edit(update, msg, InlineKeyboardMarkup(keyboard), key=key)
+    else:
+        ut.send(update, msg, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 def add_upd_button(keyboard, callback_data):
     keyboard.append(button([("🔃 Actualizar 🔃", callback_data)]))
 
 
+def live_button(transport, index, live):
+    if live:
+        return "⏹ Detener directo ⏹", f"unlive_{transport}_{index}"
+    return "🔴 En directo 🔴", f"live_{transport}_{index}"
+
+
+def add_live_button(keyboard, transport, index):
+    keyboard.append(button([live_button(transport, index, False)]))
+
+
+# swaps the live button of a board keyboard
+def live_markup(markup, transport, index, live):
+    old = live_button(transport, index, not live)[1]
+    new = button([live_button(transport, index, live)])[0]
+    return InlineKeyboardMarkup(
+        [
+            [new if bt.callback_data == old else bt for bt in row]
+            for row in markup.inline_keyboard
+        ]
+    )
+
+
+def add_alert_button(keyboard, transport, index):
+    if transport != "bici":
+        keyboard.append(
+            button([("🔔 Avisarme 🔔", f"alert_menu_{transport}_{index}")])
+        )
+
+
 def add_fav_button(keyboard, update, transport, index, stop_id):
     uid = ut.uid(update)
     if not db.favorite_cached(uid, transport, stop_id):
@@ -251,36 +332,120 @@ def bus_menu(update, transport):
             f"<b>Ejemplos</b>:\n- /interurbano <code>aluche</code>\n"
             f"- /interurbano <code>10866</code>"
         )
+    if transport != "bici":
+        kb.insert(
+            0, button([("🚏 Líneas 🚏", f"bus_lines_{transport}_0")])
+        )
     resp = ut.send
     if update.callback_query is not None:
         resp = ut.edit
     resp(update, msg, reply_markup=InlineKeyboardMarkup(kb))
 
 
+def page_buttons(callback_data, page, total):
+    buttons = []
+    if page > 0:
+        buttons.append(("« Anterior", f"{callback_data}_{page - 1}"))
+    if page < total - 1:
+        buttons.append(("Siguiente »", f"{callback_data}_{page + 1}"))
+    return buttons
+
+
+# bus_lines_<transport>_<page> -> bus_line_<transport>_<page>_<line>_0
+def bus_lines_menu(update, transport, page):
+    _answer(update)
+    page = int(page)
+    keys = ut.DATA["proc"][transport].lines.keys
+    size = ut.KB_WIDTH * ut.LINES_ROWS
+    total = max(1, -(-len(keys) // size))
+    kb = [
+        button(
+            [
+                (line, f"bus_line_{transport}_{page}_{line}_0")
+                for line in lines
+            ]
+        )
+        for lines in ut.chunk(keys[page * size : (page + 1) * size])
+    ]
+    nav = page_buttons(f"bus_lines_{transport}", page, total)
+    if nav:
+        kb.append(button(nav))
+    kb.append(
+        button(
+            [
+                (f"« {transport.upper()}", f"bus_menu_{transport}"),
+                ("« Menú", "main_menu"),
+            ]
+        )
+    )
+    transl = "EMT"
+    if transport == "urb":
+        transl = "Interurbano"
+    ut.edit(
+        update,
+        f"Líneas de {transl} ({page + 1}/{total})",
+        InlineKeyboardMarkup(kb),
+    )
+
+
+# bus_line_<transport>_<lines page>_<line>_<page> ->
+# time_bus_<transport>_<index>
+def bus_line_menu(update, transport, lines_page, line, page):
+    _answer(update)
+    page = int(page)
+    cat = ut.DATA["proc"][transport]
+    idxs = cat.lines[line]
+    size = ut.STOPS_ROWS
+    total = max(1, -(-len(idxs) // size))
+    kb = [
+        button([(cat.names[idx], f"time_bus_{transport}_{idx}")])
+        for idx in idxs[page * size : (page + 1) * size]
+    ]
+    nav = page_buttons(
+        f"bus_line_{transport}_{lines_page}_{line}", page, total
+    )
+    if nav:
+        kb.append(button(nav))
+    kb.append(
+        button(
+            [
+                ("« Líneas", f"bus_lines_{transport}_{lines_page}"),
+                ("« Menú", "main_menu"),
+            ]
+        )
+    )
+    ut.edit(
+        update,
+        f"Paradas de la Línea <b>{line}</b> "
+        f"({cat.line_names.get(line, '')}) ({page + 1}/{total})",
+        InlineKeyboardMarkup(kb),
+    )
+
+
 # time_bus_<transport>_<index>
 def bus_time(update, transport, index):
     kb = []
-    msg, stop_id = ut.text_transport(transport, index)
     _answer(update)
+    show_pending(update, transport, index)
+    msg, stop_id, key = ut.text_transport(transport, index)
     add_upd_button(kb, f"time_bus_{transport}_{index}")
+    add_live_button(kb, transport, index)
+    add_alert_button(kb, transport, index)
     add_fav_button(kb, update, transport, index, stop_id)
-    resp = ut.send
-    if update.callback_query is not None:
-        resp = ut.edit
-    resp(update, "".join(msg), reply_markup=InlineKeyboardMarkup(kb))
+    show_board(update, msg, kb, key)
 
 
 # time_cli_<transport>_<index>
 def cli_time(update, transport, index):
     kb = []
-    msg, stop_id = ut.text_transport(transport, index)
     _answer(update)
+    show_pending(update, transport, index)
+    msg, stop_id, key = ut.text_transport(transport, index)
     add_upd_button(kb, f"time_cli_{transport}_{index}")
+    add_live_button(kb, transport, index)
+    add_alert_button(kb, transport, index)
     add_fav_button(kb, update, transport, index, stop_id)
-    resp = ut.send
-    if update.callback_query is not None:
-        resp = ut.edit
-    resp(update, "".join(msg), reply_markup=InlineKeyboardMarkup(kb))
+    show_board(update, msg, kb, key)
 
 
 # favorites_menu
@@ -297,6 +462,8 @@ def favorites_menu(update):
             except KeyError:
                 continue
             else:
+                if stop is None:
+                    stop, _ = ut.transport_info(transport, index)
                 kb.append(
                     button(
                         [
@@ -316,8 +483,8 @@ def favorites_menu(update):
 
 # fav_<uid>_<transport>_<index>
 def add_favorite(update, uid, transport, index):
-    stop, stop_id = ut.transport_info(transport, index)
-    db.add_favorite(uid, transport, stop_id, stop)
+    _, stop_id = ut.transport_info(transport, index)
+    db.add_favorite(uid, transport, stop_id)
     message = update.callback_query.message
     text = ut.reformat(message.text)
     ut.edit(
@@ -339,9 +506,12 @@ def del_favorite(update, uid, transport, index):
 # time_fav_<transport>_<index>
 def time_favorite_menu(update, transport, index):
     kb = []
-    msg, _ = ut.text_transport(transport, index)
     _answer(update)
+    show_pending(update, transport, index)
+    msg, _, key = ut.text_transport(transport, index)
     add_upd_button(kb, f"time_fav_{transport}_{index}")
+    add_live_button(kb, transport, index)
+    add_alert_button(kb, transport, index)
     kb.append(
         button(
             [
@@ -361,10 +531,7 @@ def time_favorite_menu(update, transport, index):
             ]
         )
     )
-    resp = ut.send
-    if update.callback_query is not None:
-        resp = ut.edit
-    resp(update, "".join(msg), reply_markup=InlineKeyboardMarkup(kb))
+    show_board(update, msg, kb, key)
 
 
 def rename_menu(update):
@@ -380,6 +547,8 @@ def rename_menu(update):
             except KeyError:
                 continue
             else:
+                if stop is None:
+                    stop, _ = ut.transport_info(transport, index)
                 kb.append(
                     button(
                         [
@@ -400,7 +569,8 @@ def rename_menu(update):
 # rename_fav_<transport>_<index>
 def rename_favorite(update, transport, index):
     uid = ut.uid(update)
-    ut.STATE[uid] = ("rename", (transport, index))
+    _, stop_id = ut.transport_info(transport, index)
+    ut.set_state(uid, "rename", transport, stop_id)
     resp = ut.send
     if update.callback_query is not None:
         resp = ut.edit
@@ -409,3 +579,160 @@ def rename_favorite(update, transport, index):
         "De acuerdo, indícame el nuevo nombre de la estación/parada",
         reply_markup=None,
     )
+
+
+# alert_menu_<transport>_<index> -> alert_line_<transport>_<index>_<line>
+def alert_menu(update, transport, index):
+    stop, stop_id = ut.transport_info(transport, index)
+    _answer(update)
+    data, _ = ut.arrivals(transport, stop_id)
+    msg = f"No hay líneas con tiempos de llegada en <b>{stop}</b>"
+    kb = []
+    if data:
+        msg = f"¿De qué línea quieres el aviso en <b>{stop}</b>?"
+        for lines in ut.chunk(sorted(data, key=ut.sort_line)):
+            kb.append(
+                button(
+                    [
+                        (line, f"alert_line_{transport}_{index}_{line}")
+                        for line in lines
+                    ]
+                )
+            )
+    kb.append(button([("« Parada", f"time_cli_{transport}_{index}")]))
+    ut.edit(update, msg, InlineKeyboardMarkup(kb))
+
+
+# alert_line_<transport>_<index>_<line> ->
+# alert_set_<transport>_<index>_<line>_<minutes>
+def alert_line_menu(update, transport, index, line):
+    stop, _ = ut.transport_info(transport, index)
+    _answer(update)
+    kb = [
+        button(
+            [
+                (
+                    f"{mins} min",
+                    f"alert_set_{transport}_{index}_{line}_{mins}",
+                )
+                for mins in ut.ALERT_MINUTES
+            ]
+        ),
+        button([("« Líneas", f"alert_menu_{transport}_{index}")]),
+    ]
+    ut.edit(
+        update,
+        f"¿Con cuántos minutos de antelación quieres el aviso de la "
+        f"línea <b>{line}</b> en <b>{stop}</b>?",
+        InlineKeyboardMarkup(kb),
+    )
+
+
+# alert_set_<transport>_<index>_<line>_<minutes>
+def set_alert(update, transport, index, line, mins):
+    stop = ut.add_alert(ut.uid(update), transport, index, line, int(mins))
+    _answer(update, "Aviso creado")
+    kb = [
+        button(
+            [
+                ("« Parada", f"time_cli_{transport}_{index}"),
+                ("« Avisos", "alerts_menu"),
+            ]
+        )
+    ]
+    ut.edit(
+        update,
+        f"Te avisaré cuando la línea <b>{line}</b> esté a "
+        f"<code>{mins} min</code> o menos de <b>{stop}</b>.\n\n"
+        f"El aviso caduca en {ut.ALERT_TTL // 60} minutos.",
+        InlineKeyboardMarkup(kb),
+    )
+
+
+# alerts_menu -> alert_del_<id>
+def alerts_menu(update):
+    alerts = db.user_alerts(ut.uid(update))
+    _answer(update)
+    msg = "No tienes avisos activos"
+    kb = []
+    if alerts:
+        msg = "Estos son tus avisos activos, pulsa uno para cancelarlo"
+        for aid, transport, _, stop, line, mins in alerts:
+            kb.append(
+                button(
+                    [
+                        (
+                            f"❌ {transport}: {stop} ({line}, {mins} min)",
+                            f"alert_del_{aid}",
+                        )
+                    ]
+                )
+            )
+    kb.append(button([("« Menú", "main_menu")]))
+    resp = ut.send
+    if update.callback_query is not None:
+        resp = ut.edit
+    resp(update, msg, reply_markup=InlineKeyboardMarkup(kb))
+
+
+# alert_del_<id>
+def del_alert(update, aid):
+    ut.cancel_alert(ut.uid(update), int(aid))
+    alerts_menu(update)
+
+
+# live_<transport>_<index>
+def live_board(update, transport, index):
+    query = update.callback_query
+    _answer(update, "Actualizando en directo")
+    markup = query.message.reply_markup
+    ut.start_live(
+        query.bot,
+        ut.uid(update),
+        ut.message_key(update),
+        transport,
+        index,
+        live_markup(markup, transport, index, True),
+        live_markup(markup, transport, index, False),
+    )
+
+
+# unlive_<transport>_<index>
+def stop_live_board(update, transport, index):
+    query = update.callback_query
+    _answer(update)
+    ut.stop_live(ut.uid(update))
+    ut.show_live(
+        query.bot,
+        ut.message_key(update),
+        transport,
+        index,
+        live_markup(query.message.reply_markup, transport, index, False),
+    )
+
+
+# bici_near_<latitude>_<longitude> -> time_cli_bici_<index>
+def bici_nearest(update, lat, lon):
+    _answer(update)
+    stations = ut.nearest_bikes(float(lat), float(lon))
+    msg = (
+        f"No hay estaciones cercanas con {ut.BICI_MIN} bicis o más "
+        f"disponibles"
+    )
+    kb = []
+    if stations:
+        msg = f"Estaciones más cercanas con {ut.BICI_MIN} bicis o más"
+        for idx, dist, bikes in stations:
+            stop, callback_data = ut.stop_data("bici", idx)
+            kb.append(
+                button(
+                    [
+                        (
+                            f"🚲 {stop} ({bikes} bicis, "
+                            f"{ut.text_distance(dist)})",
+                            callback_data,
+                        )
+                    ]
+                )
+            )
+    ut.edit(update, msg, InlineKeyboardMarkup(kb))
@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import queue
+import threading
+import time as tm
+from collections import deque
+from datetime import timezone
+
+WINDOW = 10000  # update_ids remembered
+RATE_WINDOW = 60
+STATS = {
+    "received": 0,
+    "duplicated": 0,
+    "lagged": 0,
+    "lag_total": 0.0,
+    "lag_max": 0.0,
+}
+ARRIVALS = deque()  # arrival times within RATE_WINDOW
+LOCK = threading.Lock()
+
+
+# Telegram redelivers webhook updates when the answer is slow, every
+# update_id seen in the last WINDOW updates is dropped on arrival
+class DedupQueue(queue.Queue):
+    def __init__(self, window=WINDOW):
+        super().__init__()
+        self.window = window
+        self.seen = set()
+        self.order = deque()
+
+    def put(self, item, block=True, timeout=None):
+        update_id = getattr(item, "update_id", None)
+        if update_id is not None and not self._first(item, update_id):
+            return
+        super().put(item, block, timeout)
+
+    def _first(self, update, update_id):
+        now = tm.time()
+        with LOCK:
+            if update_id in self.seen:
+                STATS["duplicated"] += 1
+                return False
+            self.seen.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.window:
+                self.seen.discard(self.order.popleft())
+            STATS["received"] += 1
+            ARRIVALS.append(now)
+            while ARRIVALS[0] < now - RATE_WINDOW:
+                ARRIVALS.popleft()
+            # lag between the user sending the message and its arrival
+            message = getattr(update, "message", None)
+            if message is not None and message.date is not None:
+                sent = message.date
+                if sent.tzinfo is None:
+                    sent = sent.replace(tzinfo=timezone.utc)
+                lag = max(0, now - sent.timestamp())
+                STATS["lag_total"] += lag
+                STATS["lag_max"] = max(STATS["lag_max"], lag)
+                STATS["lagged"] += 1
+        return True
+
+
+def install(updater):
+    updater.update_queue = DedupQueue()
+    updater.dispatcher.update_queue = updater.update_queue
+
+
+def stats():
+    now = tm.time()
+    with LOCK:
+        while ARRIVALS and ARRIVALS[0] < now - RATE_WINDOW:
+            ARRIVALS.popleft()
+        lagged = STATS["lagged"]
+        return {
+            "received": STATS["received"],
+            "duplicated": STATS["duplicated"],
+            "rate": len(ARRIVALS) / RATE_WINDOW,
+            "lag_avg": STATS["lag_total"] / lagged if lagged else 0,
+            "lag_max": STATS["lag_max"],
+        }
@@ -0,0 +1,79 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import logging
+import queue
+import threading
+import time as tm
+
+from telegram.ext import DispatcherHandlerStop
+
+import crtm.utils as ut
+
+N_LANES = 8
+MAX_QUEUE = 100
+BLOCK = 5
+LANES = []
+LOCAL = threading.local()
+STATS = {"processed": 0, "dropped": 0, "wait_total": 0.0, "wait_max": 0.0}
+LOCK = threading.Lock()
+
+
+# each chat always goes to the same lane, so its updates are handled in
+# order while different chats are handled in parallel; the worker already
+# picked the chat by shard % workers, so lanes use the remaining digits
+def start(dispatcher, n_lanes=N_LANES, size=MAX_QUEUE):
+    for idx in range(n_lanes):
+        lane = queue.Queue(size)
+        threading.Thread(
+            target=_run,
+            args=(dispatcher, lane),
+            name=f"lane-{idx}",
+            daemon=True,
+        ).start()
+        LANES.append(lane)
+
+
+def _run(dispatcher, lane):
+    LOCAL.lane = True
+    while True:
+        queued, update = lane.get()
+        wait = tm.monotonic() - queued
+        with LOCK:
+            STATS["processed"] += 1
+            STATS["wait_total"] += wait
+            STATS["wait_max"] = max(STATS["wait_max"], wait)
+        try:
+            dispatcher.process_update(update)
+        except Exception:
+            logging.exception("Lane failed processing update")
+
+
+# first handler of every update: outside the lanes it queues the update
+# and stops the dispatcher, inside them it lets the handlers run; a full
+# lane blocks the dispatcher up to BLOCK seconds before dropping
+def route(update, _):
+    if getattr(LOCAL, "lane", False) or not LANES:
+        return
+    lane = LANES[(ut.shard(update) // ut.SHARD[1]) % len(LANES)]
+    try:
+        lane.put((tm.monotonic(), update), timeout=BLOCK)
+    except queue.Full:
+        with LOCK:
+            STATS["dropped"] += 1
+        logging.warning(f"Lane full, update {update.update_id} dropped")
+    raise DispatcherHandlerStop
+
+
+def stats():
+    with LOCK:
+        processed = STATS["processed"]
+        return {
+            "depth": sum(lane.qsize() for lane in LANES),
+            "processed": processed,
+            "dropped": STATS["dropped"],
+            "wait_avg": STATS["wait_total"] / processed if processed else 0,
+            "wait_max": STATS["wait_max"],
+        }
@@ -0,0 +1,195 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import heapq
+import itertools
+import logging
+import threading
+import time as tm
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import crtm.deadline as dl
+
+EDIT = 0
+SEND = 1
+ADMIN = 2
+RATE = 30  # global messages per second (Bot API limit)
+CHAT_INTERVAL = 1  # seconds between new messages to the same chat
+MAX_RETRIES = 3
+SENDERS = 4
+TIMEOUT = 60
+GRACE = 5  # seconds an update may wait for its answer past its deadline
+
+READY = []  # (priority, seq, job)
+DELAYED = []  # (not_before, priority, seq, job)
+NEXT = {}  # chat -> earliest time the chat can receive another message
+COND = threading.Condition()
+SEQ = itertools.count()
+POOL = None
+STATS = {
+    "sent": 0,
+    "retries": 0,
+    "failed": 0,
+    "delay_total": 0.0,
+    "delay_max": 0.0,
+}
+
+
+class Job:
+    __slots__ = (
+        "chat",
+        "priority",
+        "fn",
+        "args",
+        "kwargs",
+        "future",
+        "queued",
+        "attempts",
+        "cancelled",
+    )
+
+    def __init__(self, chat, priority, fn, args, kwargs):
+        self.chat = chat
+        self.priority = priority
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.queued = tm.monotonic()
+        self.attempts = 0
+        self.cancelled = False
+
+
+def start():
+    global POOL
+    POOL = ThreadPoolExecutor(SENDERS, thread_name_prefix="outbox")
+    threading.Thread(target=_scheduler, name="outbox", daemon=True).start()
+
+
+# queues the job without waiting for it to be sent
+def post(chat, priority, fn, *args, **kwargs):
+    with COND:
+        if POOL is None:
+            start()
+        job = Job(chat, priority, fn, args, kwargs)
+        heapq.heappush(READY, (priority, next(SEQ), job))
+        COND.notify()
+    return job
+
+
+def call(chat, priority, fn, *args, **kwargs):
+    return wait(post(chat, priority, fn, *args, **kwargs))
+
+
+# an update waits for its answer until its deadline plus GRACE, so a
+# flooded queue does not hold its lane for TIMEOUT; threads without a
+# deadline (jobs) wait up to TIMEOUT
+def wait(job):
+    from telegram.error import TimedOut
+
+    left = dl.remaining(None)
+    timeout = TIMEOUT if left is None else min(TIMEOUT, left + GRACE)
+    try:
+        return job.future.result(timeout=timeout)
+    except FutureTimeout:
+        # the caller gave up, the job must not be sent afterwards
+        with COND:
+            job.cancelled = True
+        raise TimedOut()
+
+
+def _delay(job, not_before):
+    heapq.heappush(DELAYED, (not_before, job.priority, next(SEQ), job))
+
+
+def _scheduler():
+    interval = 1 / RATE
+    last = 0
+    while True:
+        with COND:
+            now = tm.monotonic()
+            while DELAYED and DELAYED[0][0] <= now:
+                _, priority, seq, job = heapq.heappop(DELAYED)
+                heapq.heappush(READY, (priority, seq, job))
+            job = None
+            while READY:
+                _, _, candidate = heapq.heappop(READY)
+                if candidate.cancelled:
+                    continue
+                # the per chat limit is for new messages, edits are only
+                # bound by the global rate
+                if (
+                    candidate.priority != EDIT
+                    and NEXT.get(candidate.chat, 0) > now
+                ):
+                    _delay(candidate, NEXT[candidate.chat])
+                else:
+                    job = candidate
+                    break
+            if job is None:
+                timeout = None
+                if DELAYED:
+                    timeout = DELAYED[0][0] - now
+                COND.wait(timeout)
+                continue
+            if job.priority != EDIT:
+                NEXT[job.chat] = now + CHAT_INTERVAL
+            if len(NEXT) > 10000:
+                for chat in [c for c, t in NEXT.items() if t <= now]:
+                    del NEXT[chat]
+        pause = last + interval - tm.monotonic()
+        if pause > 0:
+            tm.sleep(pause)
+        last = tm.monotonic()
+        POOL.submit(_send, job)
+
+
+def _send(job):
+    from telegram.error import RetryAfter
+
+    if job.cancelled:
+        return
+    job.attempts += 1
+    started = tm.monotonic()
+    try:
+        res = job.fn(*job.args, **job.kwargs)
+    except RetryAfter as ra:
+        with COND:
+            if job.attempts <= MAX_RETRIES:
+                STATS["retries"] += 1
+                # retry_after already is the wait asked by telegram
+                not_before = tm.monotonic() + ra.retry_after
+                NEXT[job.chat] = not_before
+                _delay(job, not_before)
+                COND.notify()
+                return
+            STATS["failed"] += 1
+        logging.warning(f"Giving up sending to {job.chat}: {ra}")
+        job.future.set_exception(ra)
+    except Exception as e:
+        with COND:
+            STATS["failed"] += 1
+        job.future.set_exception(e)
+    else:
+        with COND:
+            delay = started - job.queued
+            STATS["sent"] += 1
+            STATS["delay_total"] += delay
+            STATS["delay_max"] = max(STATS["delay_max"], delay)
+        job.future.set_result(res)
+
+
+def stats():
+    with COND:
+        sent = STATS["sent"]
+        return {
+            "depth": len(READY) + len(DELAYED),
+            "sent": sent,
+            "retries": STATS["retries"],
+            "failed": STATS["failed"],
+            "delay_avg": STATS["delay_total"] / sent if sent else 0,
+            "delay_max": STATS["delay_max"],
+        }
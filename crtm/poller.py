@@ -0,0 +1,77 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import heapq
+import logging
+import threading
+import time as tm
+
+HEAP = []  # (next_poll, key)
+SUBS = {}  # key -> {sub_id: (handler, every)}
+SCHEDULED = set()
+LOCK = threading.Lock()
+
+
+def subscribe(key, sub_id, handler, every):
+    with LOCK:
+        SUBS.setdefault(key, {})[sub_id] = (handler, every)
+        if key not in SCHEDULED:
+            SCHEDULED.add(key)
+            heapq.heappush(HEAP, (tm.time(), key))
+
+
+def unsubscribe(key, sub_id):
+    with LOCK:
+        subs = SUBS.get(key)
+        if subs is not None:
+            subs.pop(sub_id, None)
+            if not subs:
+                del SUBS[key]
+
+
+def subscribed(key, sub_id):
+    with LOCK:
+        return sub_id in SUBS.get(key, ())
+
+
+# every due key is fetched once and the result fanned out to all its
+# subscribers; a handler returning False is unsubscribed
+def tick(fetch, *args):
+    now = tm.time()
+    due = []
+    with LOCK:
+        while HEAP and HEAP[0][0] <= now:
+            _, key = heapq.heappop(HEAP)
+            if key in SUBS:
+                due.append(key)
+            else:
+                SCHEDULED.discard(key)
+    for key in due:
+        try:
+            result = fetch(key)
+        except Exception:
+            logging.exception(f"Polling {key} failed")
+            result = None, None
+        with LOCK:
+            subs = list(SUBS.get(key, {}).items())
+        for sub_id, (handler, _) in subs:
+            try:
+                keep = handler(result, *args)
+            except Exception:
+                logging.exception(f"Subscriber {sub_id} of {key} failed")
+                keep = True
+            if not keep:
+                unsubscribe(key, sub_id)
+        with LOCK:
+            if key in SUBS:
+                every = min(every for _, every in SUBS[key].values())
+                heapq.heappush(HEAP, (now + every, key))
+            else:
+                SCHEDULED.discard(key)
+
+
+def stats():
+    with LOCK:
+        return len(SUBS), sum(len(subs) for subs in SUBS.values())
@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import heapq
+import threading
+import time as tm
+
+HALF_LIFE = 30 * 60
+MAX_KEYS = 5000
+MIN_SCORE = 0.05  # below it scores are pruned
+# a single hit never makes a stop hot, two hits within a half-life do
+HOT_SCORE = 1.5
+SCORES = {}  # (transport, stop_id) -> (score, last_hit)
+LOCK = threading.Lock()
+
+
+def _decayed(score, last, now):
+    return score * 0.5 ** ((now - last) / HALF_LIFE)
+
+
+def hit(transport, stop_id):
+    key = (transport, stop_id)
+    now = tm.time()
+    with LOCK:
+        score, last = SCORES.get(key, (0, now))
+        SCORES[key] = (_decayed(score, last, now) + 1, now)
+        if len(SCORES) > MAX_KEYS:
+            _prune(now)
+
+
+def _prune(now):
+    for key in [
+        k
+        for k, (sc, last) in SCORES.items()
+        if _decayed(sc, last, now) < MIN_SCORE
+    ]:
+        del SCORES[key]
+
+
+def hottest(n, floor=HOT_SCORE):
+    now = tm.time()
+    with LOCK:
+        scored = [
+            (_decayed(sc, last, now), key)
+            for key, (sc, last) in SCORES.items()
+        ]
+    return [
+        (key, score)
+        for score, key in heapq.nlargest(n, scored)
+        if score >= floor
+    ]
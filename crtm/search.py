@@ -0,0 +1,267 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import islice
+
+LIMIT = 50
+MAX_CHECKS = 40
+RE_TOKEN = re.compile(r"[A-Z0-9]+")
+RE_STREET = re.compile(r"\bC/")
+ABBREV = {
+    "AV": "AVENIDA",
+    "AVD": "AVENIDA",
+    "AVDA": "AVENIDA",
+    "PZ": "PLAZA",
+    "PZA": "PLAZA",
+    "PL": "PLAZA",
+    "PLZA": "PLAZA",
+    "CL": "CALLE",
+    "CTRA": "CARRETERA",
+    "CRTA": "CARRETERA",
+    "PS": "PASEO",
+    "PO": "PASEO",
+    "GTA": "GLORIETA",
+    "STA": "SANTA",
+    "STO": "SANTO",
+    "URB": "URBANIZACION",
+    "COL": "COLONIA",
+    "HOSP": "HOSPITAL",
+    "UNIV": "UNIVERSIDAD",
+    "PQUE": "PARQUE",
+    "BO": "BARRIO",
+}
+INDEX = {}
+
+
+def fold(text):
+    nfkd = unicodedata.normalize("NFKD", text)
+    return "".join([c for c in nfkd if not unicodedata.combining(c)]).upper()
+
+
+def tokens(text):
+    text = RE_STREET.sub("CALLE ", fold(text))
+    return [ABBREV.get(tk, tk) for tk in RE_TOKEN.findall(text)]
+
+
+def trigrams(token):
+    padded = f" {token} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(token):
+    if len(token) < 4:
+        return 0
+    if len(token) < 7:
+        return 1
+    return 2
+
+
+# optimal string alignment distance (levenshtein plus transpositions),
+# gives up as soon as it exceeds `limit`
+def distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cost = ca != cb
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if (
+                prev2 is not None
+                and j > 1
+                and ca == b[j - 2]
+                and a[i - 2] == cb
+            ):
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+def build(transport, names):
+    exact = {}
+    full = []
+    postings = {}
+    stop_tokens = []
+    for idx, name in enumerate(names):
+        tks = tokens(name) if name is not None else []
+        stop_tokens.append(tuple(tks))
+        if not tks:
+            continue
+        key = " ".join(tks)
+        exact.setdefault(key, []).append(idx)
+        full.append((key, idx))
+        for tk in set(tks):
+            postings.setdefault(tk, []).append(idx)
+    full.sort()
+    grams = {}
+    for tk in postings:
+        for gram in trigrams(tk):
+            grams.setdefault(gram, []).append(tk)
+    INDEX[transport] = {
+        "exact": exact,
+        "full": full,
+        "vocab": sorted(postings),
+        "postings": postings,
+        "tokens": stop_tokens,
+        "grams": grams,
+    }
+
+
+def add(transport, idx, name):
+    index = INDEX[transport]
+    tks = tuple(tokens(name))
+    while len(index["tokens"]) <= idx:
+        index["tokens"].append(())
+    index["tokens"][idx] = tks
+    if not tks:
+        return
+    key = " ".join(tks)
+    index["exact"].setdefault(key, []).append(idx)
+    insort(index["full"], (key, idx))
+    for tk in set(tks):
+        if tk not in index["postings"]:
+            index["postings"][tk] = []
+            insort(index["vocab"], tk)
+            for gram in trigrams(tk):
+                index["grams"].setdefault(gram, []).append(tk)
+        index["postings"][tk].append(idx)
+
+
+# tokens left without stops stay in the vocabulary, they are harmless
+def remove(transport, idx):
+    index = INDEX[transport]
+    tks = index["tokens"][idx]
+    index["tokens"][idx] = ()
+    if not tks:
+        return
+    key = " ".join(tks)
+    index["exact"][key].remove(idx)
+    if not index["exact"][key]:
+        del index["exact"][key]
+    index["full"].remove((key, idx))
+    for tk in set(tks):
+        index["postings"][tk].remove(idx)
+
+
+def _prefixed(pairs, prefix):
+    start = bisect_left(pairs, (prefix,))
+    for key, idx in islice(pairs, start, None):
+        if not key.startswith(prefix):
+            break
+        yield idx
+
+
+def _vocab_prefixed(index, prefix):
+    vocab = index["vocab"]
+    pos = bisect_left(vocab, prefix)
+    while pos < len(vocab) and vocab[pos].startswith(prefix):
+        yield vocab[pos]
+        pos += 1
+
+
+# candidates must share enough trigrams with the token: every edit
+# breaks at most 3 of them, 4 for a transposition
+def _vocab_similar(index, token):
+    limit = max_typos(token)
+    if not limit:
+        return {}
+    shared = Counter()
+    for gram in trigrams(token):
+        shared.update(index["grams"].get(gram, ()))
+    needed = max(len(token) - 4 * limit, 1)
+    similar = {}
+    for tk, count in shared.most_common(MAX_CHECKS):
+        if count < needed:
+            break
+        dist = distance(token, tk, limit)
+        if dist <= limit and index["postings"][tk]:
+            similar[tk] = 1 - dist / len(token)
+    return similar
+
+
+# per query token, the vocabulary tokens it matches with their score:
+# 1 for prefixes, below 1 for close spellings of words matching nothing
+def _options(index, qtks):
+    options = []
+    for tk in qtks:
+        sims = {vtk: 1 for vtk in _vocab_prefixed(index, tk)}
+        if not sims:
+            sims = _vocab_similar(index, tk)
+            if not sims:
+                return None
+        options.append(sims)
+    return options
+
+
+# stops covering every query token. The most selective token produces the
+# candidates, the rest only filter them; without typos every match scores
+# the same so it stops after `limit` matches
+def _matches(index, options, limit):
+    postings = index["postings"]
+    options.sort(key=lambda sims: sum(len(postings[tk]) for tk in sims))
+    first, rest = options[0], options[1:]
+    exact = all(sim == 1 for sims in options for sim in sims.values())
+    candidates = {}
+    for tk, sim in first.items():
+        for idx in postings[tk]:
+            if candidates.get(idx, 0) < sim:
+                candidates[idx] = sim
+    scores = {}
+    for idx in sorted(candidates):
+        score = candidates[idx]
+        for sims in rest:
+            best = max([sims.get(tk, 0) for tk in index["tokens"][idx]])
+            if not best:
+                break
+            score += best
+        else:
+            scores[idx] = score
+            if exact and len(scores) >= limit:
+                break
+    return scores
+
+
+# ranked by exact > prefix > token prefix > typo-tolerant match; each
+# tier is only explored while fewer than `limit` results were found
+def query(transport, words, limit=LIMIT):
+    index = INDEX.get(transport)
+    qtks = tokens(" ".join(words))
+    if index is None or not qtks:
+        return []
+    results = []
+    seen = set()
+
+    def add(idxs):
+        for idx in idxs:
+            if idx not in seen:
+                seen.add(idx)
+                results.append(idx)
+                if len(results) >= limit:
+                    return True
+        return False
+
+    key = " ".join(qtks)
+    if add(index["exact"].get(key, ())):
+        return results
+    if add(_prefixed(index["full"], key)):
+        return results
+    options = _options(index, qtks)
+    if options is not None:
+        scores = _matches(index, options, limit + len(results))
+        best = heapq.nlargest(
+            limit - len(results),
+            ((sc, -idx) for idx, sc in scores.items() if idx not in seen),
+        )
+        add(-neg for _, neg in best)
+    return results
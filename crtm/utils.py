@@ -5,30 +5,61 @@
 # Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
 # This work is licensed under the terms of the MIT license.
 
+import hashlib
+import heapq
+import io
 import json
 import logging
+import os
 import re
+import resource
+import secrets
+import threading
+import time as tm
 import traceback
 import unicodedata
-from datetime import datetime, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
 
-import pytz  # type: ignore
-import requests as req  # type: ignore
-from bs4 import BeautifulSoup
-from telegram import (
-    InlineQueryResultArticle,
-    InputTextMessageContent,
-    ParseMode,
-)
-from telegram.error import BadRequest, Unauthorized
-
+import crtm.bicimad as bicimad
+import crtm.breaker as breaker
+import crtm.cache as cache
+import crtm.catalogue as catalogue
 import crtm.database as db
-import crtm.gui as gui
+import crtm.deadline as deadline
+import crtm.geo as geo
+import crtm.gtfs as gtfs
+import crtm.ingress as ingress
+import crtm.outbox as outbox
+import crtm.poller as poller
+import crtm.popularity as popularity
+import crtm.search as search
 import crtm.private.endpoints as end  # not uploaded for privacy reasons
 
 STATE = {}
+RENDERED = OrderedDict()
+RENDERED_SIZE = 2048
+SHOWN = OrderedDict()
+SHOWN_SIZE = 4096
+PENDING = {}  # message -> [timer, outbox job] of its placeholder
+PENDING_DELAY = 0.3
+MEMO_LOCK = threading.Lock()  # RENDERED and SHOWN, updates run in lanes
+STATE_TTL = 15 * 60
+STATE_PURGE = 5 * 60
 KB_WIDTH = 4
+LINES_ROWS = 8
+STOPS_ROWS = 10
+CURSOR_TTL = 10 * 60
+NEAREST = 8
+TRANSPORT_EMOJI = {
+    "bici": "🚲",
+    "metro": "🚇",
+    "cerc": "🚆",
+    "emt": "🚎",
+    "urb": "🚌",
+}
 LOGO = (
     "https://raw.githubusercontent.com/"
     "scmanjarrez/CRTM-Telegram-Bot/master/logos"
@@ -56,13 +87,50 @@ FILES = {
     "cerc": "data/cercanias.json",
     "emt": "data/emt.json",
     "urb": "data/interurbanos.json",
+    "cache": "config/cache.sock",
+    "meta": "data/meta.json",
+    "gtfs": "data/gtfs.db",
+}
+SOURCES = ("cerc", "emt", "urb", "bici")
+# coordinate fields of each upstream dataset, None for geojson geometry
+POSITION = {
+    "cerc": ("lat", "lon"),
+    "emt": ("la", "lo"),
+    "urb": ("la", "lo"),
+    "bici": None,
+    "metro": ("latitud", "longitud"),
 }
+VERSIONS = {}
+REFRESH_INTERVAL = 60 * 60
+PARSER = 3  # bump to reparse downloaded datasets after format changes
+PREWARM_EVERY = 10
+PREWARM_TOP = 20
+PREWARM_BUDGET = 10
+WEATHER_TTL = 10 * 60
+BICI_EVERY = 30
+BICI_MIN = 3
+ALERT_TTL = 60 * 60
+ALERT_POLL = 30
+POLL_TICK = 5
+ALERT_MINUTES = (3, 5, 10, 15)
+SHARD = (0, 1)  # (worker index, number of workers)
+STALE = (
+    "⚠️ <i>El servicio no responde, estos son los últimos datos "
+    "conocidos.</i>"
+)
+UPDATING = "⏳ <i>Actualizando…</i>"
+LIVE = {}  # owner -> (stop key, subscription, finish)
+LIVE_TTL = 5 * 60
+LIVE_EVERY = 15
+BOOT = tm.perf_counter()
+STARTUP = {}  # phase -> seconds
 OCCUP = {
     0: "Baja",
     1: "Media",
     2: "Alta",
     3: "No disponible",
 }
+DOWNLOAD = True
 PREFIX = {
     "emt": "EMT_",
     "urb": "CRTM_par_8_",
@@ -75,6 +143,22 @@ DATA = {}
 #     print(req.request.url, req.request.body, req.request.headers)
 
 
+@contextmanager
+def phase(name):
+    start = tm.perf_counter()
+    yield
+    STARTUP[name] = tm.perf_counter() - start
+    logging.info(f"Startup phase {name}: {STARTUP[name]:.3f}s")
+
+
+def first_update():
+    if "first_update" not in STARTUP:
+        STARTUP["first_update"] = tm.perf_counter() - BOOT
+        logging.info(
+            f"First update {STARTUP['first_update']:.3f}s after start"
+        )
+
+
 def load_config():
     global CONFIG
     with open(FILES["cfg"]) as f:
@@ -85,7 +169,9 @@ def load_config():
         pass
 
 
-def setting(key):
+def setting(key, default=None):
+    if default is not None:
+        return CONFIG["settings"].get(key, default)
     return CONFIG["settings"][key]
 
 
@@ -97,186 +183,427 @@ def admin(key):
     return CONFIG["admin"][key]
 
 
+def load_meta():
+    try:
+        with open(FILES["meta"]) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_meta(meta):
+    tmp = f"{FILES['meta']}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp, FILES["meta"])
+
+
+# datasets are only parsed and rewritten when their content changed;
+# each change bumps the source version in data/meta.json
 def download_api_data():
-    # --- cercanias
-    cerc_path = Path(FILES["cerc"])
-    cerc_path.parent.mkdir(exist_ok=True)
-    get = end.download_cerc()
-    if get.status_code != 200:
-        return
-    data = parse_cerc_data(get.json())
-    with cerc_path.open("w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    # --- emt
-    emt_path = Path(FILES["emt"])
-    emt_path.parent.mkdir(exist_ok=True)
-    get = end.download_emt()
-    if get.status_code != 200:
-        return
-    data = parse_api_data(get.json())
-    with emt_path.open("w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    # --- interurbanos
-    urb_path = Path(FILES["urb"])
-    get = end.download_urb()
-    if get.status_code != 200:
-        return
-    data = parse_api_data(get.json())
-    # --- bicimad
-    with urb_path.open("w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    bici_path = Path(FILES["bici"])
-    get = end.download_bici()
-    if get.status_code != 200:
-        return
-    data = parse_bici_data(get.json())
-    with bici_path.open("w") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    meta = load_meta()
+    for source in SOURCES:
+        path = Path(FILES[source])
+        path.parent.mkdir(exist_ok=True)
+        get = download_source(source)
+        if get.status_code != 200:
+            continue
+        info = meta.setdefault(source, {"version": 0})
+        digest = hashlib.blake2b(get.content, digest_size=16).hexdigest()
+        if (
+            info.get("hash") == digest
+            and info.get("parser") == PARSER
+            and path.is_file()
+        ):
+            continue
+        before = reset_peak_rss()
+        write_dataset(path, parse_source(source, get.content))
+        logging.info(
+            f"Dataset {source} written: "
+            f"{path.stat().st_size / 2**20:.1f} MiB, "
+            f"RSS {before:.1f} MiB before, "
+            f"{peak_rss():.1f} MiB peak while parsing"
+        )
+        info["hash"] = digest
+        info["parser"] = PARSER
+        info["etag"] = get.headers.get("ETag")
+        info["modified"] = get.headers.get("Last-Modified")
+        info["version"] += 1
+    save_meta(meta)
+
+
+def download_source(source):
+    if source == "cerc":
+        return end.download_cerc()
+    elif source == "emt":
+        return end.download_emt()
+    elif source == "urb":
+        return end.download_urb()
+    return end.download_bici()
+
+
+# compact on disk, written aside and renamed so readers never see a
+# partial dataset
+def write_dataset(path, data):
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("w") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def rss_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024
+
+
+# linux lets a process reset its peak RSS (VmHWM), so the peak read
+# afterwards belongs to the refresh and not to the whole process life;
+# returns the current RSS
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return rss_status("VmRSS:")
+    except OSError:
+        return 0
+
+
+def peak_rss():
+    try:
+        return rss_status("VmHWM:")
+    except OSError:
+        # kilobytes on linux, peak of the whole process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 
+# the payload is parsed one element at a time instead of building the
+# whole document first
+def parse_source(source, content):
+    import ijson
 
-def parse_api_data(data, fill=None):
-    names = fill
-    if names is None:
-        names = {"station": {}, "line": {}}
-    for el in data["elements"]:
-        if el["r"]["n"] not in names["line"]:
+    def items(prefix):
+        return ijson.items(io.BytesIO(content), prefix, use_float=True)
+
+    if source == "cerc":
+        return parse_cerc_data(items("item"))
+    elif source == "bici":
+        return parse_bici_data(items("data.item"))
+    indexes = {}
+    return parse_api_data(source, api_elements(content, indexes), indexes)
+
+
+# single pass over the payload, yields each route and fills indexes
+# with uiStopIndexes, that may come before or after the routes
+def api_elements(content, indexes):
+    import ijson
+
+    builder = target = None
+    for prefix, event, value in ijson.parse(
+        io.BytesIO(content), use_float=True
+    ):
+        if builder is None:
+            if prefix not in ("elements.item", "uiStopIndexes") or (
+                event not in ("start_map", "start_array")
+            ):
+                continue
+            builder, target = ijson.ObjectBuilder(), prefix
+        builder.event(event, value)
+        if prefix == target and event in ("end_map", "end_array"):
+            if target == "uiStopIndexes":
+                indexes.update(builder.value)
+            else:
+                yield builder.value
+            builder = None
+
+
+def position(source, item):
+    if POSITION[source] is None:
+        return geo.geojson(item)
+    return geo.coords(item, *POSITION[source])
+
+
+# stops without coordinates are left out of the nearest stops search
+def check_positions(source, stops):
+    missing = sum(1 for stop in stops if stop["pos"] is None)
+    if missing:
+        logging.warning(
+            f"{missing} of {len(stops)} {source} stops without coordinates"
+        )
+
+
+def parse_api_data(source, elements, indexes):
+    names = {"station": {}, "line": {}}
+    for el in elements:
+        if el["r"]["i"] not in names["line"]:
             names["line"][el["r"]["i"]] = {}
             names["line"][el["r"]["i"]]["id"] = el["r"]["h"]
             names["line"][el["r"]["i"]]["name"] = el["r"]["n"]
+            names["line"][el["r"]["i"]]["stops"] = []
+        # stops in route order, the way back only adds the missing ones
+        stops = names["line"][el["r"]["i"]]["stops"]
         for sts in el["sts"]:
+            if sts["i"] not in stops:
+                stops.append(sts["i"])
             if sts["i"] not in names["station"]:
                 names["station"][sts["i"]] = {}
                 names["station"][sts["i"]]["name"] = sts["n"]
-                names["station"][sts["i"]]["lineIds"] = data["uiStopIndexes"][
-                    sts["i"]
-                ]
+                names["station"][sts["i"]]["pos"] = position(source, sts)
+    # indexes are complete once every element has been read
+    for stop_id, station in names["station"].items():
+        station["lineIds"] = indexes[stop_id]
+    check_positions(source, list(names["station"].values()))
     return names
 
 
-def parse_bici_data(data):
+def parse_bici_data(stations):
     names = {}
-    for station in data["data"]:
+    for station in stations:
         names[station["number"]] = {
             "id": station["id"],
             "name": station["name"],
+            "pos": position("bici", station),
         }
+    check_positions("bici", list(names.values()))
     return names
 
 
-def parse_cerc_data(data):
+def parse_cerc_data(stations):
     names = []
-    for station in data:
+    for station in stations:
         stop = {
             "id": station["s"]["h"],
             "name": station["s"]["n"],
             "lineIds": list(set([s["n"][:2] for s in station["r"]])),
+            "pos": position("cerc", station["s"]),
         }
         names.append(stop)
+    check_positions("cerc", names)
     return names
 
 
 def load_data():
-    ## TODO: uncomment this line!!!!
-    download_api_data()
-    with open(FILES["bici"], "r") as f:
-        DATA["raw"]["bici"] = json.load(f)
-    with open(FILES["cerc"], "r") as f:
-        DATA["raw"]["cerc"] = json.load(f)
-    with open(FILES["metro"], "r") as f:
-        DATA["raw"]["metro"] = json.load(f)
-    with open(FILES["emt"], "r") as f:
-        DATA["raw"]["emt"] = json.load(f)
-    with open(FILES["urb"], "r") as f:
-        DATA["raw"]["urb"] = json.load(f)
-
-
-def bici_lines():
-    for idx, (station, info) in enumerate(DATA["raw"]["bici"].items()):
-        DATA["proc"]["bici"]["index"][station] = idx
-        DATA["proc"]["bici"]["names"].append(info["name"])
-        DATA["proc"]["bici"]["ids"].append(station)
-        DATA["proc"]["bici"]["stopids"].append(info["id"])
-
-
-def train_lines():
-    for idx, info in enumerate(DATA["raw"]["cerc"]):
-        DATA["proc"]["cerc"]["index"][info["id"]] = idx
-        DATA["proc"]["cerc"]["names"].append(info["name"])
-        DATA["proc"]["cerc"]["ids"].append(info["id"])
-        first = info["name"][0]
-        if first not in DATA["proc"]["cerc"]["stops"]:
-            DATA["proc"]["cerc"]["stops"][first] = []
-        DATA["proc"]["cerc"]["stops"][first].append(idx)
-        for line in info["lineIds"]:
-            if line not in DATA["proc"]["cerc"]["lines"]:
-                DATA["proc"]["cerc"]["lines"][line] = {}
-            if first not in DATA["proc"]["cerc"]["lines"][line]:
-                DATA["proc"]["cerc"]["lines"][line][first] = []
-            DATA["proc"]["cerc"]["lines"][line][first].append(idx)
-
-
-def metro_ids():
+    if DOWNLOAD:
+        download_api_data()
+    raw = {}
+    for source in SOURCES + ("metro",):
+        with open(FILES[source], "r") as f:
+            raw[source] = json.load(f)
+    return raw
+
+
+def entries(source, data):
+    if source == "cerc":
+        return ((info["id"], info) for info in data)
+    if source == "bici":
+        return data.items()
+    return data["station"].items()
+
+
+def fingerprint(info):
+    return hash(json.dumps(info, sort_keys=True))
+
+
+def set_stop(source, idx, key, info, fp):
+    DATA["proc"][source].set(
+        idx,
+        key,
+        info["name"],
+        info.get("pos"),
+        stopid=info["id"] if source == "bici" else 0,
+        fp=fp,
+        lines=info["lineIds"] if source == "cerc" else (),
+    )
+
+
+def link_stop(source, idx):
+    cat = DATA["proc"][source]
+    search.add(source, idx, cat.names[idx])
+    if cat.pos(idx) is not None:
+        geo.add(*cat.pos(idx), source, idx)
+
+
+def unlink_stop(source, idx):
+    cat = DATA["proc"][source]
+    search.remove(source, idx)
+    if cat.pos(idx) is not None:
+        geo.remove(*cat.pos(idx), source, idx)
+
+
+def set_routes(source, data):
+    if is_bus(source):
+        cat = DATA["proc"][source]
+        cat.routes = {
+            route: catalogue.intern(info["id"])
+            for route, info in data["line"].items()
+        }
+        lines = {}
+        names = {}
+        for route, info in data["line"].items():
+            line = cat.routes[route]
+            names.setdefault(line, info["name"])
+            lines.setdefault(line, {})
+            for key in info.get("stops", ()):
+                if key in cat.index:
+                    lines[line].setdefault(cat.index[key])
+        cat.link_routes(
+            {line: list(lines[line]) for line in sorted(lines, key=sort_line)},
+            names,
+        )
+
+
+def build_stops(source, data):
+    for idx, (key, info) in enumerate(entries(source, data)):
+        set_stop(source, idx, key, info, fingerprint(info))
+    set_routes(source, data)
+    if source == "cerc":
+        DATA["proc"][source].link_lines()
+
+
+# removed stops keep their slot (tombstone) so the indexes in callbacks
+# stay valid until the next full build
+def apply_diff(source, data):
+    cat = DATA["proc"][source]
+    new = {key: fingerprint(info) for key, info in entries(source, data)}
+    added = changed = 0
+    removed = cat.index.keys() - new.keys()
+    for key in removed:
+        idx = cat.index[key]
+        unlink_stop(source, idx)
+        cat.drop(idx)
+    for key, info in entries(source, data):
+        idx = cat.index.get(key)
+        if idx is None:
+            idx = len(cat)
+            added += 1
+        elif cat.hashes[idx] != new[key]:
+            unlink_stop(source, idx)
+            changed += 1
+        else:
+            continue
+        set_stop(source, idx, key, info, new[key])
+        link_stop(source, idx)
+    set_routes(source, data)
+    if source == "cerc":
+        cat.link_lines()
+    logging.info(
+        f"Catalogue {source} updated: {added} added, "
+        f"{len(removed)} removed, {changed} changed"
+    )
+
+
+def refresh_data(_):
+    if DOWNLOAD:
+        download_api_data()
+    meta = load_meta()
+    for source in SOURCES:
+        version = meta.get(source, {}).get("version", 0)
+        if version != VERSIONS.get(source):
+            with open(FILES[source]) as f:
+                apply_diff(source, json.load(f))
+            VERSIONS[source] = version
+    refresh_metro()
+    # timetables ingested by the downloading process are picked up by
+    # the rest on their next refresh
+    if DOWNLOAD:
+        gtfs.refresh()
+    elif gtfs.changed():
+        gtfs.load()
+
+
+# the metro dataset is a local file, it is rebuilt when it is replaced
+def refresh_metro():
+    mtime = os.path.getmtime(FILES["metro"])
+    if mtime == VERSIONS.get("metro"):
+        return
+    with open(FILES["metro"]) as f:
+        data = json.load(f)
+    cat = catalogue.Catalogue()
+    metro_lines(cat, data)
+    old = DATA["proc"]["metro"]
+    DATA["proc"]["metro"] = cat
+    search.build("metro", cat.names)
+    for idx in range(len(old)):
+        if old.pos(idx) is not None:
+            geo.remove(*old.pos(idx), "metro", idx)
+    for idx in range(len(cat)):
+        if cat.pos(idx) is not None:
+            geo.add(*cat.pos(idx), "metro", idx)
+    VERSIONS["metro"] = mtime
+    logging.info(f"Catalogue metro rebuilt: {len(cat)} stations")
+
+
+# the dataset has one row per (station, line), stations are merged by
+# name into a single record holding all their lines
+def metro_stations(data):
     stations = {}
-    for st in DATA["raw"]["metro"]["red"]["estaciones"]["estacion"]:
-        name = st["name"]
-        web = st["idweb"]
-        if name not in stations:
-            stations[name] = {"idweb": set(), "idmatriz": set()}
-        if "idMatriz" in st:
-            stations[name]["idmatriz"].add(st["idMatriz"])
-        stations[name]["idweb"].add(web)
-    staids = {}
-    staall = {}
-    for k, v in stations.items():
-        staid = list(v["idweb"])[0]
-        if len(v["idmatriz"]) > 0:
-            staall[staid] = list(v["idmatriz"])[0]
-        staids[k] = staid
-    return staids, staall
-
-
-def metro_lines():
-    staids, staall = metro_ids()
-    DATA["proc"]["metro"]["idsmat"] = staall
-    for idx, info in enumerate(
-        DATA["raw"]["metro"]["red"]["estaciones"]["estacion"]
-    ):
-        staid = staids[info["name"]]
-        DATA["proc"]["metro"]["index"][staid] = idx
-        DATA["proc"]["metro"]["names"].append(info["name"])
-        DATA["proc"]["metro"]["ids"].append(staids[info["name"]])
-        first = info["name"][0]
-        if first not in DATA["proc"]["metro"]["stops"]:
-            DATA["proc"]["metro"]["stops"][first] = []
-        DATA["proc"]["metro"]["stops"][first].append(idx)
-        line_id = info["linea"]
-        if line_id not in DATA["proc"]["metro"]["lines"]:
-            DATA["proc"]["metro"]["lines"][line_id] = {}
-        if first not in DATA["proc"]["metro"]["lines"][line_id]:
-            DATA["proc"]["metro"]["lines"][line_id][first] = []
-        DATA["proc"]["metro"]["lines"][line_id][first].append(idx)
-
-
-def transport_lines(transport):
-    for idx, (station, info) in enumerate(
-        DATA["raw"][transport]["station"].items()
-    ):
-        DATA["proc"][transport]["index"][station] = idx
-        DATA["proc"][transport]["names"].append(info["name"])
-        DATA["proc"][transport]["ids"].append(station)
+    for st in data["red"]["estaciones"]["estacion"]:
+        info = stations.setdefault(
+            st["name"], {"idweb": {}, "lines": {}, "pos": None}
+        )
+        info["idweb"].setdefault(st["idweb"])
+        if info["pos"] is None:
+            info["pos"] = position("metro", st)
+        info["lines"].setdefault(st["linea"])
+    check_positions("metro", list(stations.values()))
+    return stations
+
+
+def metro_lines(cat, data):
+    canonical = {}
+    for idx, (name, info) in enumerate(metro_stations(data).items()):
+        stop_id, *aliases = info["idweb"]
+        cat.set(idx, stop_id, name, info["pos"], lines=info["lines"])
+        # old keyboards and favorites may use any of the station ids
+        for alias in aliases:
+            cat.index[alias] = idx
+            canonical[alias] = stop_id
+    cat.link_lines()
+    if DOWNLOAD:
+        db.canonical_favorites("metro", canonical)
+
+
+def shard(update):
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
 
 
 def uid(update):
     return update.effective_message.chat.id
 
 
-def blocked(uid):
+# the database cascade removes the alerts, their pollers are stopped here
+def del_user(uid):
+    for aid, transport, stop_id, *_ in db.user_alerts(uid):
+        poller.unsubscribe((transport, stop_id), ("alert", aid))
+    stop_live(uid)
     db.del_user(uid)
 
 
+def blocked(uid):
+    del_user(uid)
+
+
+# sends and edits of the same chat share the outbox per chat key,
+# inline messages have no chat and use their own id
+def outbox_chat(update):
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return message_key(update)
+
+
 def send(update, msg, quote=True, reply_markup=None, disable_preview=True):
+    from telegram.error import TimedOut, Unauthorized
+
     try:
-        return update.message.reply_html(
+        return outbox.call(
+            outbox_chat(update),
+            outbox.SEND,
+            update.message.reply_html,
             msg,
             quote=quote,
             reply_markup=reply_markup,
@@ -284,11 +611,26 @@ def send(update, msg, quote=True, reply_markup=None, disable_preview=True):
         )
     except Unauthorized:
         blocked(update.effective_message.chat.id)
+    except TimedOut:
+        logging.warning(f"Sending to {outbox_chat(update)} timed out")
+
 
+def send_bot(
+    bot,
+    uid,
+    msg,
+    reply_markup=None,
+    disable_preview=True,
+    priority=outbox.SEND,
+):
+    from telegram import ParseMode
+    from telegram.error import TimedOut, Unauthorized
 
-def send_bot(bot, uid, msg, reply_markup=None, disable_preview=True):
     try:
-        return bot.send_message(
+        return outbox.call(
+            uid,
+            priority,
+            bot.send_message,
             uid,
             msg,
             ParseMode.HTML,
@@ -297,11 +639,57 @@ def send_bot(bot, uid, msg, reply_markup=None, disable_preview=True):
         )
     except Unauthorized:
         blocked(uid)
+    except TimedOut:
+        logging.warning(f"Sending to {uid} timed out")
+
+
+def message_key(update):
+    query = update.callback_query
+    if query.inline_message_id is not None:
+        return query.inline_message_id
+    return query.message.chat.id, query.message.message_id
+
 
+def content_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
 
-def edit(update, msg, reply_markup, disable_preview=True):
+
+# SHOWN keeps, per chat message or inline message, a small key of the
+# last content sent so edits that would not modify it are not sent
+def unchanged(mkey, key):
+    with MEMO_LOCK:
+        if SHOWN.get(mkey) == key:
+            SHOWN.move_to_end(mkey)
+            return True
+        SHOWN[mkey] = key
+        SHOWN.move_to_end(mkey)
+        if len(SHOWN) > SHOWN_SIZE:
+            SHOWN.popitem(last=False)
+        return False
+
+
+def forget(mkey):
+    with MEMO_LOCK:
+        SHOWN.pop(mkey, None)
+
+
+def edit(update, msg, reply_markup, disable_preview=True, key=None):
+    from telegram import ParseMode
+    from telegram.error import BadRequest, TimedOut
+
+    mkey = message_key(update)
+    if key is None:
+        key = content_hash(msg)
+    if reply_markup is not None:
+        key = (key, content_hash(reply_markup.to_json()))
+    settle(mkey)
+    if unchanged(mkey, key):
+        return
     try:
-        update.callback_query.edit_message_text(
+        outbox.call(
+            outbox_chat(update),
+            outbox.EDIT,
+            update.callback_query.edit_message_text,
             msg,
             ParseMode.HTML,
             reply_markup=reply_markup,
@@ -309,12 +697,63 @@ def edit(update, msg, reply_markup, disable_preview=True):
         )
     except BadRequest as br:
         if not str(br).startswith("Message is not modified:"):
+            forget(mkey)
             print(
                 f"***  Exception caught in edit "
                 f"({update.effective_message.chat.id}): ",
                 br,
             )
             traceback.print_stack()
+    except TimedOut:
+        forget(mkey)
+        logging.warning(f"Editing {mkey} timed out")
+    except Exception:
+        # the message did not get this content, next refresh must edit it
+        forget(mkey)
+        raise
+
+
+# STATE[uid] = (expires, state, transport, stop_id)
+def get_state(uid):
+    entry = STATE.get(uid)
+    if entry is None:
+        return None
+    if entry[0] <= tm.time():
+        del_state(uid)
+        return None
+    return entry[1:]
+
+
+def set_state(uid, state, transport=None, stop_id=None):
+    expires = int(tm.time()) + setting("state_ttl", STATE_TTL)
+    STATE[uid] = (expires, state, transport, stop_id)
+    if setting("state_db", True):
+        db.set_state(uid, expires, state, transport, stop_id)
+
+
+def del_state(uid):
+    if STATE.pop(uid, None) is not None and setting("state_db", True):
+        db.del_state(uid)
+
+
+def load_states():
+    if setting("state_db", True):
+        for uid, *entry in db.states(int(tm.time())):
+            STATE[uid] = tuple(entry)
+
+
+def purge_states(_):
+    now = tm.time()
+    for uid in [uid for uid, entry in STATE.items() if entry[0] <= now]:
+        STATE.pop(uid, None)
+    if setting("state_db", True):
+        db.del_expired_states(int(now))
+
+
+def state_cleaner(queue):
+    queue.run_repeating(
+        purge_states, STATE_PURGE, context=queue, name="state_cleaner"
+    )
 
 
 def not_started(update):
@@ -352,8 +791,15 @@ def weather_info(data):
     return res
 
 
+# requests is only imported with the first upstream call
+def http():
+    import requests  # type: ignore
+
+    return requests
+
+
 def weather():
-    get = req.get(
+    get = http().get(
         f"{end.URL['weather']}",
         params={
             "lat": 40.49,
@@ -362,6 +808,7 @@ def weather():
             "lang": "es",
         },
         headers=end.headers(),
+        timeout=max(deadline.remaining(), 1),
     )
     data = get.json()
     info = {
@@ -375,16 +822,47 @@ def weather():
 def bici(stop_id):
     try:
         get = end.get_bici(stop_id)
-    except req.exceptions.ReadTimeout:
+    except http().exceptions.ReadTimeout:
         return None
     else:
-        return get.json()
+        data = get.json()
+        if data and data["data"]:
+            return data["data"][0]
+        return {}
+
+
+def bici_stations():
+    get = end.download_bici()
+    if get.status_code != 200:
+        return None
+    return get.json()["data"]
+
+
+# the status of every station is fetched at once, workers share it
+# through the cache so only one of them calls upstream per interval
+def refresh_bici(_):
+    stations, version = cache.fetch(
+        ("bici", "all"),
+        deadline.run,
+        breaker.call,
+        "bici",
+        bici_stations,
+        ttl=BICI_EVERY,
+    )
+    if version is not None:
+        bicimad.update(stations, version)
+
+
+def bici_snapshot(queue):
+    queue.run_repeating(
+        refresh_bici, BICI_EVERY, first=0, context=queue, name="bici"
+    )
 
 
 def cercanias(stop_id):
     try:
         get = end.get_cercanias(stop_id)
-    except req.exceptions.ReadTimeout:
+    except http().exceptions.ReadTimeout:
         return None
     else:
         if get.text in (
@@ -406,9 +884,12 @@ def cercanias(stop_id):
 
 
 def metro(stop_id):
+    # bs4 and lxml are only loaded with the first metro request
+    from bs4 import BeautifulSoup
+
     try:
         get = end.get_metro(stop_id)
-    except req.exceptions.ReadTimeout:
+    except http().exceptions.ReadTimeout:
         return None
     else:
         soup = BeautifulSoup(get.text, "lxml-xml")
@@ -456,7 +937,7 @@ def metro(stop_id):
 def bus(transport, stop_id):
     try:
         get = end.get_bus(transport, stop_id)
-    except req.exceptions.ReadTimeout:
+    except http().exceptions.ReadTimeout:
         return None
     else:
         if get.text in (
@@ -481,7 +962,7 @@ def bus(transport, stop_id):
                     else:
                         time = f"{binfo['s'] // 60}min"
                 times.append(time)
-            bid = DATA["raw"][transport]["line"][bs["r"]]["id"]
+            bid = DATA["proc"][transport].routes[bs["r"]]
             info[bid] = {}
             info[bid]["name"] = bs["h"]
             info[bid]["times"] = times
@@ -489,13 +970,11 @@ def bus(transport, stop_id):
 
 
 def transport_info(transport, index):
-    ids = "ids"
+    cat = DATA["proc"][transport]
+    ids = cat.ids
     if transport == "bici":
-        ids = "stopids"
-    return (
-        DATA["proc"][transport]["names"][int(index)],
-        DATA["proc"][transport][ids][int(index)],
-    )
+        ids = cat.stopids
+    return cat.names[int(index)], ids[int(index)]
 
 
 def chunk(lst):
@@ -521,7 +1000,19 @@ def reformat(text):
 
 
 def text_weather():
-    data = weather()
+    data, version = cache.fetch(
+        ("weather",),
+        deadline.run,
+        breaker.call,
+        "weather",
+        weather,
+        ttl=WEATHER_TTL,
+    )
+    if data is None:
+        return [
+            "<b>Debido a un error en el servicio del tiempo "
+            "no es posible obtener información en estos momentos.</b>"
+        ]
     msg = [
         f"<b>Clima en este momento</b>\n"
         f"- Resumen: <code>{data['now']['summ']}</code>\n",
@@ -543,19 +1034,82 @@ def text_weather():
             f"({day['tempmin']}-{day['tempmax']}ºC, "
             f"{day['hum']}%, {day['rain']}%)</code>\n"
         )
+    if version is None:
+        msg.append(f"\n{STALE}")
+    return msg
+
+
+def text_status():
+    import crtm.lanes as lanes
+
+    out = outbox.stats()
+    msg = [
+        "<b>Cola de envío</b>\n",
+        f"- Pendientes: <code>{out['depth']}</code>\n",
+        f"- Enviados: <code>{out['sent']}</code>\n",
+        f"- Reintentos: <code>{out['retries']}</code>\n",
+        f"- Fallidos: <code>{out['failed']}</code>\n",
+        f"- Espera media: <code>{out['delay_avg']:.2f}s</code>\n",
+        f"- Espera máxima: <code>{out['delay_max']:.2f}s</code>\n",
+    ]
+    ing = ingress.stats()
+    lane = lanes.stats()
+    msg.extend(
+        [
+            "\n<b>Cola de actualizaciones</b>\n",
+            f"- Recibidas: <code>{ing['received']}</code> "
+            f"(<code>{ing['rate']:.2f}/s</code>)\n",
+            f"- Duplicadas: <code>{ing['duplicated']}</code>\n",
+            f"- Retraso medio: <code>{ing['lag_avg']:.2f}s</code>\n",
+            f"- Retraso máximo: <code>{ing['lag_max']:.2f}s</code>\n",
+            f"- Pendientes: <code>{lane['depth']}</code>\n",
+            f"- Procesadas: <code>{lane['processed']}</code>\n",
+            f"- Descartadas: <code>{lane['dropped']}</code>\n",
+            f"- Espera media: <code>{lane['wait_avg']:.2f}s</code>\n",
+            f"- Espera máxima: <code>{lane['wait_max']:.2f}s</code>\n",
+        ]
+    )
+    stops, subs = poller.stats()
+    msg.extend(
+        [
+            "\n<b>Avisos</b>\n",
+            f"- Paradas vigiladas: <code>{stops}</code>\n",
+            f"- Suscripciones: <code>{subs}</code>\n",
+            f"- Paneles en directo: <code>{len(LIVE)}</code>\n",
+        ]
+    )
+    if STARTUP:
+        msg.append("\n<b>Arranque</b>\n")
+        for name, secs in STARTUP.items():
+            msg.append(f"- {name}: <code>{secs:.2f}s</code>\n")
+    health = breaker.health()
+    if health:
+        msg.append("\n<b>Proveedores</b>\n")
+        for provider, brk in sorted(health.items()):
+            msg.append(
+                f"- {provider}: <code>{brk['state']}</code> "
+                f"({brk['ok']} ok, {brk['failed']} fallos, "
+                f"{brk['rejected']} rechazadas)\n"
+            )
+    hot = popularity.hottest(5, popularity.MIN_SCORE)
+    if hot:
+        msg.append("\n<b>Paradas más consultadas</b>\n")
+        for (transport, stop_id), score in hot:
+            msg.append(
+                f"- {transport} {stop_id}: <code>{score:.1f}</code>\n"
+            )
     return msg
 
 
-def text_bici(stop, stop_id):
+def text_bici(stop, data):
     msg = [f"Estadísticas de estación <b>{stop}</b>\n\n"]
-    data = bici(stop_id)
     if data is not None:
-        if data and data["data"]:
-            info = data["data"][0]
+        if data:
+            info = data
             state = "activa" if info["activate"] else "inactiva"
             msg.append(f"- <b>Estado</b>: <code>{state}</code>\n")
-            addr = info["address"]
-            if addr[-1] == ",":
+            addr = info.get("address") or ""
+            if addr.endswith(","):
                 addr = addr[:-1]
             msg.append(f"- <b>Dirección</b>: <code>{addr}</code>\n")
             msg.append(
@@ -584,9 +1138,8 @@ def text_bici(stop, stop_id):
     return msg
 
 
-def text_metro(stop, stop_id):
+def text_metro(stop, data):
     msg = [f"Tiempos en estación <b>{stop}</b>\n\n"]
-    data = metro(stop_id)
     if data is not None:
         if data:
             for line in sorted(data, key=sort_line):
@@ -611,9 +1164,8 @@ def text_metro(stop, stop_id):
     return msg
 
 
-def text_cercanias(stop, stop_id):
+def text_cercanias(stop, data):
     msg = [f"Tiempos en estación <b>{stop}</b>\n\n"]
-    data = cercanias(stop_id)
     if data is not None:
         if data:
             for line in sorted(data, key=sort_line):
@@ -648,12 +1200,11 @@ def text_cercanias(stop, stop_id):
     return msg
 
 
-def text_bus(transport, stop, stop_id):
+def text_bus(transport, stop, stop_id, data):
     msg = [
         f"Tiempos en parada <b>{stop} "
         f"({stop_id.replace(PREFIX[transport], '')})</b>\n\n"
     ]
-    data = bus(transport, stop_id)
     if data is not None:
         if data:
             for line in sorted(data, key=sort_line):
@@ -674,10 +1225,46 @@ def text_bus(transport, stop, stop_id):
     return msg
 
 
+def text_wait(secs):
+    if secs <= 60:
+        return "Llegando"
+    if secs > 3600:
+        return f"{secs // 3600}:{(secs % 3600) // 60:02}h"
+    return f"{secs // 60}min"
+
+
+def text_scheduled(transport, stop, stop_id):
+    import pytz  # type: ignore
+
+    if transport == "bici":
+        return None
+    code = stop_id.replace(PREFIX.get(transport, ""), "")
+    # GTFS times are Madrid wall clock
+    now = datetime.now(pytz.timezone("Europe/Madrid"))
+    departures = gtfs.next_departures(transport, code, now)
+    if not departures:
+        return None
+    msg = [
+        f"Horario programado en <b>{stop}</b>\n\n",
+        "🗓 <i>El servicio de tiempo real no responde, estos tiempos son "
+        "los del horario oficial.</i>\n\n",
+    ]
+    lines = {}
+    for wait, line, headsign in departures:
+        lines.setdefault((line, headsign), []).append(text_wait(wait))
+    for (line, headsign), times in sorted(
+        lines.items(), key=lambda item: sort_line(item[0][0])
+    ):
+        msg.append(f"<b>Línea {line}:</b>\n")
+        msg.append(f"- Destino: <code>{headsign}</code>\n")
+        msg.append(f"- Tiempo(s): <code>{', '.join(times)}</code>\n\n")
+    return "".join(msg)
+
+
 def index(transport, stop_id):
     if transport == "bici":
-        return DATA["proc"][transport]["stopids"].index(int(stop_id))
-    return DATA["proc"][transport]["index"][stop_id]
+        return DATA["proc"][transport].stopids.index(int(stop_id))
+    return DATA["proc"][transport].index[stop_id]
 
 
 def store_message(text, rep=False):
@@ -711,50 +1298,182 @@ def stop_data(transport, index, inline=False):
     return (stop, f"{prefix}_{transport}_{index}")
 
 
+# removed stops are dropped from the search index, this also guards
+# against results computed while a refresh runs
+def search_stops(transport, stopnames):
+    names = DATA["proc"][transport].names
+    return [
+        idx
+        for idx in search.query(transport, stopnames)
+        if names[idx] is not None
+    ]
+
+
 def stopname_matches(transport, stopnames, inline=False):
-    stops = list(enumerate(DATA["proc"][transport]["names"]))
-    for word in stopnames:
-        stops = [
-            (index, stop)
-            for index, stop in stops
-            if normalize(word) in normalize(stop)
-        ]
-    if transport == "metro":
-        uniq = {stop: idx for idx, stop in stops}
-        return [
-            stop_data(transport, index, inline) for _, index in uniq.items()
-        ]
-    else:
-        return [stop_data(transport, index, inline) for index, _ in stops]
+    idxs = search_stops(transport, stopnames)
+    return [stop_data(transport, index, inline) for index in idxs]
 
 
+# search results are kept server side so paging never searches again,
+# callbacks only carry the cursor id and the page
+def search_cursor(transport, stopnames):
+    idxs = search_stops(transport, stopnames)
+    if not idxs:
+        return None
+    cid = secrets.token_hex(4)
+    if cache.STORE is None:
+        cache.local()
+    cache.STORE.set(("cursor", cid), (transport, list(idxs)), CURSOR_TTL)
+    return cid
+
+
+def cursor(cid):
+    data, fresh = cache.peek(("cursor", cid))
+    if fresh:
+        return data
+
+
+# removed stops (tombstones) are no longer in the catalogue index
 def stopnumber_match(transport, stopnumber):
-    match = False
-    for idx, stop_id in enumerate(DATA["proc"][transport]["ids"]):
-        if transport == "bici":
-            cmp = stopnumber
-        else:
-            cmp = f"{PREFIX[transport]}{stopnumber}"
-        if cmp == stop_id:
-            match = True
-            break
-    return match, idx
+    key = stopnumber
+    if transport != "bici":
+        key = f"{PREFIX[transport]}{stopnumber}"
+    idx = DATA["proc"][transport].index.get(key)
+    return idx is not None, idx
 
 
-def text_transport(transport, index):
-    stop, stop_id = transport_info(transport, index)
+def arrivals(transport, stop_id, refresh=False):
+    if transport == "bici":
+        snap = bicimad.current()
+        info = None if snap is None else snap.station(stop_id)
+        if info is not None:
+            return info, hash(tuple(info.values()))
+        fn, args = bici, (stop_id,)
+    elif transport == "metro":
+        fn, args = metro, (stop_id,)
+    elif transport == "cerc":
+        fn, args = cercanias, (stop_id,)
+    else:
+        fn, args = bus, (transport, stop_id)
+    return cache.fetch(
+        (transport, stop_id),
+        deadline.run,
+        breaker.call,
+        transport,
+        fn,
+        *args,
+        refresh=refresh,
+    )
+
+
+def render(transport, stop, stop_id, data):
     if transport == "bici":
-        msg = text_bici(stop, stop_id)
+        msg = text_bici(stop, data)
     elif transport == "metro":
-        msg = text_metro(stop, stop_id)
+        msg = text_metro(stop, data)
     elif transport == "cerc":
-        msg = text_cercanias(stop, stop_id)
+        msg = text_cercanias(stop, data)
     else:
-        msg = text_bus(transport, stop, stop_id)
-    return msg, stop_id
+        msg = text_bus(transport, stop, stop_id, data)
+    return "".join(msg)
+
+
+# board shown while the arrivals are fetched, None if they are cached
+def pending_board(transport, index):
+    stop, stop_id = transport_info(transport, index)
+    if transport == "bici" and bicimad.current() is not None:
+        return None
+    data, fresh = cache.peek((transport, stop_id))
+    if fresh:
+        return None
+    if data is None:
+        return f"⏳ Cargando tiempos de <b>{stop}</b>…"
+    return f"{render(transport, stop, stop_id, data)}\n\n{UPDATING}"
+
+
+# the placeholder only goes out if the arrivals are still being fetched
+# after PENDING_DELAY, so quick refreshes keep the shown board and skip
+# the edit when nothing changed; the next edit waits for it to keep the
+# order
+def show_pending(bot, mkey, transport, index, reply_markup):
+    msg = pending_board(transport, index)
+    if msg is None:
+        return
+    entry = [None, None]
+    entry[0] = threading.Timer(
+        PENDING_DELAY,
+        _post_pending,
+        args=(bot, mkey, entry, msg, reply_markup),
+    )
+    entry[0].daemon = True
+    with MEMO_LOCK:
+        PENDING[mkey] = entry
+    entry[0].start()
+
+
+def _post_pending(bot, mkey, entry, msg, reply_markup):
+    with MEMO_LOCK:
+        if PENDING.get(mkey) is not entry:
+            return
+        # the message stops showing the board recorded in SHOWN
+        SHOWN.pop(mkey, None)
+        entry[1] = edit_message(bot, mkey, msg, reply_markup, wait=False)
+
+
+def settle(mkey):
+    with MEMO_LOCK:
+        entry = PENDING.pop(mkey, None)
+    if entry is None:
+        return
+    entry[0].cancel()
+    if entry[1] is not None:
+        try:
+            outbox.wait(entry[1])
+        except Exception:
+            pass
+
+
+# returns the rendered board, its stop_id and a key that only changes
+# when the board does, so unchanged refreshes can skip the edit
+def text_transport(transport, index, hit=None):
+    stop, stop_id = transport_info(transport, index)
+    if hit is None:
+        popularity.hit(transport, stop_id)
+        hit = arrivals(transport, stop_id)
+    data, version = hit
+    key = (transport, stop_id, version, VERSIONS.get(transport, 0))
+    if version is None:
+        # no version to key on, edit compares the rendered text instead
+        key = None
+        if data is not None:
+            msg = f"{render(transport, stop, stop_id, data)}\n\n{STALE}"
+        else:
+            msg = text_scheduled(transport, stop, stop_id)
+            if msg is None:
+                msg = render(transport, stop, stop_id, data)
+        return msg, stop_id, key
+    with MEMO_LOCK:
+        msg = RENDERED.get(key)
+        if msg is not None:
+            RENDERED.move_to_end(key)
+    if msg is None:
+        msg = render(transport, stop, stop_id, data)
+        with MEMO_LOCK:
+            RENDERED[key] = msg
+            if len(RENDERED) > RENDERED_SIZE:
+                RENDERED.popitem(last=False)
+    return msg, stop_id, key
 
 
 def result(transport, rid, msg):
+    from telegram import (
+        InlineQueryResultArticle,
+        InputTextMessageContent,
+        ParseMode,
+    )
+
+    import crtm.gui as gui
+
     _msg = msg.split()
     pref = _msg[:3]
     sta = _msg[3:]
@@ -778,62 +1497,336 @@ def is_bus(transport):
 
 def update_data(_):
     global DATA
+    trace = setting("trace_memory", False)
+    if trace:
+        import tracemalloc
+
+        tracemalloc.start()
     DATA = {
         "cfg": None,
         "token": None,
         "bici_token": None,
-        "raw": {
-            "bici": None,
-            "metro": None,
-            "cerc": None,
-            "emt": None,
-            "urb": None,
-        },
         "idx": {
             "cerc": {0: "salidas", 1: "llegadas"},
         },
         "proc": {
-            "bici": {
-                "index": {},
-                "names": [],
-                "ids": [],
-                "stopids": [],
-            },
-            "metro": {
-                "lines": {},
-                "stops": {},
-                "index": {},
-                "names": [],
-                "ids": [],
-                "idsmat": {},
-            },
-            "cerc": {
-                "lines": {},
-                "stops": {},
-                "index": {},
-                "names": [],
-                "ids": [],
-            },
-            "emt": {"index": {}, "names": [], "ids": []},
-            "urb": {"index": {}, "names": [], "ids": []},
+            "bici": catalogue.Catalogue(),
+            "metro": catalogue.Catalogue(),
+            "cerc": catalogue.Catalogue(),
+            "emt": catalogue.Catalogue(),
+            "urb": catalogue.Catalogue(),
         },
     }
-    load_data()
-    bici_lines()
-    train_lines()
-    metro_lines()
-    transport_lines("emt")
-    transport_lines("urb")
-
-
-def downloader_daily(queue):
-    update_time = time(hour=5, tzinfo=pytz.timezone("Europe/Madrid"))
-    queue.run_daily(
-        update_data,
-        update_time,
-        days=(0,),
+    RENDERED.clear()
+    # the raw datasets are only kept while the catalogue is built
+    raw = load_data()
+    if trace:
+        loaded, _ = tracemalloc.get_traced_memory()
+    for source in SOURCES:
+        build_stops(source, raw[source])
+    metro_lines(DATA["proc"]["metro"], raw["metro"])
+    if DOWNLOAD:
+        for transport, cat in DATA["proc"].items():
+            ids = cat.stopids if transport == "bici" else cat.ids
+            db.clear_default_names(
+                transport,
+                {str(key): name for key, name in zip(ids, cat.names)},
+            )
+    if trace:
+        built, peak = tracemalloc.get_traced_memory()
+    del raw
+    meta = load_meta()
+    for source in SOURCES:
+        VERSIONS[source] = meta.get(source, {}).get("version", 0)
+    VERSIONS["metro"] = os.path.getmtime(FILES["metro"])
+    for transport, cat in DATA["proc"].items():
+        search.build(transport, cat.names)
+    geo.build(stop_points())
+    # static timetables are only ingested by the process downloading data
+    if DOWNLOAD:
+        gtfs.refresh()
+    else:
+        gtfs.load()
+    if trace:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logging.info(
+            f"Catalogue memory: {(built - loaded) / 2**20:.1f} MiB "
+            f"catalogue, {loaded / 2**20:.1f} MiB raw datasets, "
+            f"{current / 2**20:.1f} MiB retained in total, "
+            f"{peak / 2**20:.1f} MiB peak while loading"
+        )
+
+
+def stop_points():
+    for transport, cat in DATA["proc"].items():
+        for idx in range(len(cat)):
+            pos = cat.pos(idx)
+            if pos is not None:
+                yield pos[0], pos[1], transport, idx
+
+
+def nearest_stops(lat, lon, n=NEAREST, transport=None):
+    def same_transport(trans, _):
+        return trans == transport
+
+    return geo.nearest(
+        lat, lon, n, same_transport if transport is not None else None
+    )
+
+
+def nearest_bikes(lat, lon, bikes=BICI_MIN, n=NEAREST):
+    snap = bicimad.current()
+    if snap is None:
+        return []
+    stopids = DATA["proc"]["bici"].stopids
+
+    def with_bikes(transport, idx):
+        return transport == "bici" and snap.bikes(stopids[idx]) >= bikes
+
+    return [
+        (idx, dist, snap.bikes(stopids[idx]))
+        for _, idx, dist in geo.nearest(lat, lon, n, with_bikes)
+    ]
+
+
+def text_distance(meters):
+    if meters < 1000:
+        return f"{round(meters)} m"
+    return f"{meters / 1000:.1f} km"
+
+
+# refreshes the most requested stops before their cached arrivals
+# expire, spending at most `prewarm_budget` upstream calls per run
+def prewarm_stops(_):
+    top = setting("prewarm_top", PREWARM_TOP)
+    hot = popularity.hottest(top)
+    if SHARD[1] > 1:
+        # every worker publishes its hottest stops and only the first one
+        # prewarms, so the budget is not multiplied by the workers
+        cache.STORE.set(("hot", SHARD[0]), hot, PREWARM_EVERY * 3)
+        if SHARD[0] != 0:
+            return
+        scores = {}
+        for idx in range(SHARD[1]):
+            hit = cache.STORE.get(("hot", idx))
+            for key, score in hit[0] if hit is not None else ():
+                key = tuple(key)
+                scores[key] = scores.get(key, 0) + score
+        hot = heapq.nlargest(top, scores.items(), key=lambda item: item[1])
+    budget = setting("prewarm_budget", PREWARM_BUDGET)
+    margin = PREWARM_EVERY + 2
+    for key, _ in hot:
+        if budget <= 0:
+            break
+        remaining = cache.remaining(key)
+        if remaining is None or remaining < margin:
+            arrivals(*key, refresh=True)
+            budget -= 1
+
+
+def prewarmer(queue):
+    queue.run_repeating(
+        prewarm_stops, PREWARM_EVERY, context=queue, name="prewarmer"
+    )
+
+
+def minutes(text):
+    if text == "Llegando":
+        return 0
+    if text.endswith("min"):
+        return int(text[:-3])
+    if text.endswith("h"):
+        hours, mins = text[:-1].split(":")
+        return int(hours) * 60 + int(mins)
+
+
+def line_minutes(transport, data, line):
+    if not data or line not in data:
+        return []
+    if transport == "cerc":
+        return [
+            train[1] // 60
+            for trains in data[line].values()
+            for train in trains
+        ]
+    if transport == "metro":
+        times = [
+            time for info in data[line].values() for time in info["times"]
+        ]
+    else:
+        times = data[line]["times"]
+    return [mins for mins in map(minutes, times) if mins is not None]
+
+
+def watch_alert(aid, uid, transport, stop_id, stop, line, mins, expires):
+    def check(hit, bot):
+        if tm.time() >= expires:
+            db.del_alert(aid)
+            return False
+        # stale arrivals must not trigger the alert
+        if hit[1] is None:
+            return True
+        times = line_minutes(transport, hit[0], line)
+        if not times or min(times) > mins:
+            return True
+        db.del_alert(aid)
+        send_bot(
+            bot,
+            uid,
+            f"🔔 La línea <b>{line}</b> llegará a <b>{stop}</b> "
+            f"en <code>{min(times)} min</code>.",
+        )
+        return False
+
+    poller.subscribe(
+        (transport, stop_id), ("alert", aid), check, ALERT_POLL
+    )
+
+
+def add_alert(uid, transport, index, line, mins):
+    stop, stop_id = transport_info(transport, index)
+    expires = int(tm.time()) + ALERT_TTL
+    aid = db.add_alert(uid, transport, stop_id, stop, line, mins, expires)
+    watch_alert(aid, uid, transport, stop_id, stop, line, mins, expires)
+    return stop
+
+
+def cancel_alert(uid, aid):
+    alert = db.alert(uid, aid)
+    if alert is not None:
+        db.del_alert(aid)
+        poller.unsubscribe(tuple(alert), ("alert", aid))
+
+
+# each worker only watches the alerts of the chats it is sharded to
+def load_alerts():
+    now = int(tm.time())
+    db.del_expired_alerts(now)
+    for aid, uid, *alert in db.alerts(now):
+        if uid % SHARD[1] == SHARD[0]:
+            watch_alert(aid, uid, *alert)
+
+
+def poll_stops(context):
+    poller.tick(lambda key: arrivals(*key), context.bot)
+
+
+def stop_poller(queue):
+    load_alerts()
+    queue.run_repeating(
+        poll_stops, POLL_TICK, context=queue, name="stop_poller"
+    )
+
+
+def edit_message(bot, mkey, msg, reply_markup, wait=True):
+    from telegram import ParseMode
+
+    if isinstance(mkey, str):
+        chat, target = mkey, {"inline_message_id": mkey}
+    else:
+        chat, target = mkey[0], {"chat_id": mkey[0], "message_id": mkey[1]}
+    if not wait:
+        return outbox.post(
+            chat,
+            outbox.EDIT,
+            bot.edit_message_text,
+            msg,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup,
+            disable_web_page_preview=True,
+            **target,
+        )
+    settle(mkey)
+    outbox.call(
+        chat,
+        outbox.EDIT,
+        bot.edit_message_text,
+        msg,
+        parse_mode=ParseMode.HTML,
+        reply_markup=reply_markup,
+        disable_web_page_preview=True,
+        **target,
+    )
+
+
+# edits a board outside of a callback, returns False when the message
+# can no longer be edited
+def show_live(bot, mkey, transport, index, reply_markup, hit=None):
+    from telegram.error import BadRequest, TimedOut, Unauthorized
+
+    msg, _, key = text_transport(transport, index, hit)
+    if key is None:
+        key = content_hash(msg)
+    if unchanged(mkey, (key, content_hash(reply_markup.to_json()))):
+        return True
+    try:
+        edit_message(bot, mkey, msg, reply_markup)
+    except BadRequest as br:
+        if not str(br).startswith("Message is not modified:"):
+            forget(mkey)
+            return False
+    except Unauthorized:
+        if not isinstance(mkey, str):
+            blocked(mkey[0])
+        return False
+    except TimedOut:
+        forget(mkey)
+    except Exception:
+        forget(mkey)
+        raise
+    return True
+
+
+# every owner has at most one live board, refreshed through the stop
+# poller so all the boards of a stop share the same upstream request
+def start_live(bot, owner, mkey, transport, index, live_kb, idle_kb):
+    _, stop_id = transport_info(transport, index)
+    key = (transport, stop_id)
+    sub_id = ("live", mkey)
+    prev = stop_live(owner)
+    if prev is not None and prev[1] != sub_id:
+        prev[2]()
+    expires = tm.time() + setting("live_ttl", LIVE_TTL)
+
+    def finish():
+        show_live(bot, mkey, transport, index, idle_kb)
+
+    def refresh(hit, bot):
+        if LIVE.get(owner, (None, None))[1] != sub_id:
+            return False
+        if tm.time() >= expires:
+            LIVE.pop(owner, None)
+            finish()
+            return False
+        # keep the last board while upstream is failing
+        if hit[1] is None:
+            return True
+        if not show_live(bot, mkey, transport, index, live_kb, hit):
+            LIVE.pop(owner, None)
+            return False
+        return True
+
+    LIVE[owner] = (key, sub_id, finish)
+    show_live(bot, mkey, transport, index, live_kb)
+    poller.subscribe(key, sub_id, refresh, setting("live_every", LIVE_EVERY))
+
+
+def stop_live(owner):
+    live = LIVE.pop(owner, None)
+    if live is not None:
+        poller.unsubscribe(live[0], live[1])
+    return live
+
+
+def downloader(queue, delay=0):
+    interval = setting("refresh_interval", REFRESH_INTERVAL)
+    queue.run_repeating(
+        refresh_data,
+        interval,
+        first=interval + delay,
         context=queue,
-        name="downloader_daily",
+        name="downloader",
     )
 
 
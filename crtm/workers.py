@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2022-2026 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue, TypeHandler, Updater
+
+import crtm.cache as cache
+import crtm.cli as cli
+import crtm.ingress as ingress
+import crtm.outbox as outbox
+import crtm.utils as ut
+
+LOAD_WAIT = 10 * 60
+QUEUES = []
+PROCS = []
+
+
+def forward(update, _):
+    QUEUES[ut.shard(update) % len(QUEUES)].put(update.to_json())
+
+
+def worker(idx, n_workers, updates, authkey, setup, loaded):
+    # first worker downloads the datasets, the rest only reload them
+    ut.DOWNLOAD = idx == 0
+    ut.SHARD = (idx, n_workers)
+    # the global Bot API limit is split between workers
+    outbox.RATE = outbox.RATE / n_workers
+    cache.connect(ut.FILES["cache"], authkey)
+    bot = Bot(ut.setting("token"))
+    jobs = JobQueue()
+    dispatcher = Dispatcher(
+        bot, queue.Queue(), workers=0, job_queue=jobs, use_context=True
+    )
+    jobs.set_dispatcher(dispatcher)
+    setup(dispatcher)
+    # the rest wait until the first one has written the datasets
+    if idx != 0 and not loaded.wait(LOAD_WAIT):
+        logging.warning(f"Worker {idx} loading without waiting worker 0")
+    with ut.phase("data"):
+        ut.update_data(None)
+    if idx == 0:
+        loaded.set()
+    ut.downloader(jobs, delay=0 if idx == 0 else 5 * 60)
+    ut.state_cleaner(jobs)
+    ut.prewarmer(jobs)
+    ut.stop_poller(jobs)
+    ut.bici_snapshot(jobs)
+    jobs.start()
+    logging.info(f"Worker {idx} ({os.getpid()}) ready")
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            try:
+                dispatcher.process_update(
+                    Update.de_json(json.loads(data), bot)
+                )
+            except Exception:
+                logging.exception(f"Worker {idx} failed processing update")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        jobs.stop()
+
+
+def start(setup, n_workers):
+    authkey = os.urandom(16)
+    cache.serve(ut.FILES["cache"], authkey)
+    loaded = mp.Event()
+    for idx in range(n_workers):
+        updates = mp.Queue()
+        proc = mp.Process(
+            target=worker,
+            args=(idx, n_workers, updates, authkey, setup, loaded),
+            name=f"crtm-worker-{idx}",
+        )
+        proc.start()
+        QUEUES.append(updates)
+        PROCS.append(proc)
+
+    updater = Updater(token=ut.setting("token"), use_context=True)
+    ingress.install(updater)
+    updater.bot.set_my_commands(cli.HELP_CMD.items())
+    updater.dispatcher.add_handler(TypeHandler(Update, forward))
+    return updater
+
+
+def stop():
+    for updates in QUEUES:
+        updates.put(None)
+    for proc in PROCS:
+        proc.join(timeout=10)
+    cache.shutdown()